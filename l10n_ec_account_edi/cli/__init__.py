@@ -0,0 +1,2 @@
+from . import sri_signer
+from . import sri_simulator
@@ -0,0 +1,229 @@
+import argparse
+import base64
+import logging
+import multiprocessing
+import os
+import signal
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+import odoo
+from odoo.cli import Command
+from odoo.tools import ustr
+
+from ..models.sri_key_type import (
+    CertificateCache,
+    load_certificate,
+    receive_message,
+    send_message,
+    sign_xml_tree,
+)
+
+_logger = logging.getLogger(__name__)
+
+# certificados decodificados en cada proceso de firma del servicio
+_process_keys = None
+
+
+def parse_key(key):
+    """
+    :param key: clave del certificado, base de datos:id:checksum
+        el nombre de la base de datos puede contener ":"
+    :return: tuple(base de datos, id, checksum)
+    """
+    return tuple(key.rsplit(":", 2))
+
+
+def _init_signing_process(max_keys):
+    """Prepara un proceso de firma, con su propia cache de certificados"""
+    global _process_keys
+    # la interrupcion la maneja el proceso principal, que cierra el pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _process_keys = CertificateCache(max_keys, 64 * 1024 * 1024)
+
+
+def _sign_in_process(key, xml, file_content, password):
+    """
+    Firma el documento en un proceso del pool, el certificado
+    se decodifica solo la primera vez que el proceso lo usa
+    :return: str con el nodo ds:Signature
+    """
+    p12 = _process_keys.get(key)
+    if p12 is None:
+        p12 = load_certificate(file_content, password)
+        _process_keys.put(key, p12, len(file_content))
+    doc = sign_xml_tree(etree.fromstring(xml), p12)
+    return etree.tostring(doc[-1], encoding="unicode", with_tail=False)
+
+
+class SigningRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            message = receive_message(self.request)
+            if message is None:
+                break
+            send_message(self.request, self.server.dispatch(message))
+
+
+class SigningService(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Servicio local de firma electronica compartido por los workers de Odoo
+    La firma(canonicalizacion y hash) usa cpu, se ejecuta en un pool
+    de procesos, uno por cada worker del servicio, los hilos solo
+    atienden las conexiones. Cada proceso decodifica el certificado
+    una sola vez
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers, max_keys=64):
+        # contenido del pkcs12 y contraseña de cada certificado cargado
+        self.keys = CertificateCache(max_keys, 64 * 1024 * 1024)
+        self.workers = workers
+        # fork antes de atender conexiones, sin otros hilos activos
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_signing_process,
+            initargs=(max_keys,),
+        )
+        self.pool.submit(int).result()
+        self._semaphore = threading.BoundedSemaphore(workers)
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self.in_flight = 0
+        self.active = 0
+        self.requests = 0
+        self.errors = 0
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # solo el usuario que ejecuta el servicio puede conectarse
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, SigningRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def dispatch(self, message):
+        method = message.get("method")
+        try:
+            if method == "sign":
+                return self.sign(message["key"], message["xml"])
+            if method == "load":
+                return self.load(message["key"], message["pkcs12"], message["password"])
+            if method == "stats":
+                return {"result": self.info()}
+        except Exception as e:
+            _logger.warning("Error in signing service: %s", ustr(e))
+            return {"error": "exception", "message": ustr(e)}
+        return {"error": "unknown_method", "message": method}
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+    def load(self, key, pkcs12, password):
+        file_content = base64.b64decode(pkcs12)
+        # validar el certificado antes de enviarlo a los procesos
+        load_certificate(file_content, password)
+        self.keys.put(parse_key(key), (file_content, password), len(file_content))
+        _logger.info("Certificate loaded in signing service: %s", key)
+        return {"result": True}
+
+    def sign(self, key, xml):
+        key = parse_key(key)
+        credentials = self.keys.get(key)
+        if credentials is None:
+            return {"error": "unknown_key"}
+        start = time.perf_counter()
+        with self._stats_lock:
+            self.in_flight += 1
+            self.requests += 1
+        try:
+            with self._semaphore:
+                with self._stats_lock:
+                    self.active += 1
+                try:
+                    signature = self.pool.submit(
+                        _sign_in_process, key, xml, *credentials
+                    ).result()
+                finally:
+                    with self._stats_lock:
+                        self.active -= 1
+            return {"signature": signature}
+        except Exception as e:
+            with self._stats_lock:
+                self.errors += 1
+            return {"error": "sign_error", "message": ustr(e)}
+        finally:
+            with self._stats_lock:
+                self.in_flight -= 1
+                self._latencies.append(time.perf_counter() - start)
+
+    def info(self):
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            res = {
+                "workers": self.workers,
+                "in_flight": self.in_flight,
+                "queue_depth": self.in_flight - self.active,
+                "requests": self.requests,
+                "errors": self.errors,
+                "keys": self.keys.info(),
+            }
+        if latencies:
+            res.update(
+                {
+                    "latency_avg_ms": sum(latencies) / len(latencies) * 1000,
+                    "latency_p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+                    "latency_max_ms": latencies[-1] * 1000,
+                }
+            )
+        return res
+
+
+class SriSigner(Command):
+    """Start the shared SRI signing service on a unix socket
+
+    odoo-bin --addons-path=... srisigner --socket /run/odoo/sri_signer.sock
+
+    Then set l10n_ec_signing_service_socket in the Odoo configuration file
+    so the workers delegate sri.key.type signing to this process.
+    Each service worker is a signing process using one CPU core,
+    use as many workers as cores can be dedicated to signing.
+    """
+
+    def run(self, args):
+        parser = argparse.ArgumentParser(
+            prog="odoo-bin srisigner",
+            description="Shared electronic signing service for SRI documents",
+        )
+        parser.add_argument("--socket", required=True, help="Unix socket path")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of signing processes, each one uses a CPU core "
+            "(default: number of CPUs)",
+        )
+        opts = parser.parse_args(args)
+        odoo.netsvc.init_logger()
+        server = SigningService(opts.socket, opts.workers)
+        _logger.info(
+            "SRI signing service listening on %s with %s workers",
+            opts.socket,
+            opts.workers,
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            _logger.info("SRI signing service stopped")
+        finally:
+            server.server_close()
+            if os.path.exists(opts.socket):
+                os.unlink(opts.socket)
@@ -0,0 +1,326 @@
+import argparse
+import base64
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lxml import etree
+
+import odoo
+from odoo.cli import Command
+from odoo.tools import ustr
+
+_logger = logging.getLogger(__name__)
+
+NS_SOAP = "http://schemas.xmlsoap.org/soap/envelope/"
+NS_RECEPTION = "http://ec.gob.sri.ws.recepcion"
+NS_AUTHORIZATION = "http://ec.gob.sri.ws.autorizacion"
+# hora de Ecuador continental, como la devuelve el SRI
+SRI_TIMEZONE = timezone(timedelta(hours=-5))
+
+
+def parse_latency(spec):
+    """
+    Convierte la especificacion de latencia en una funcion
+    que recibe un random.Random y devuelve los segundos a esperar
+        fixed:S, uniform:MIN:MAX, normal:MEAN:STDDEV,
+        lognormal:MU:SIGMA, exponential:MEAN
+    """
+    name, *values = spec.split(":")
+    values = [float(value) for value in values]
+    distributions = {
+        "fixed": (1, lambda rng, s: s),
+        "uniform": (2, lambda rng, low, high: rng.uniform(low, high)),
+        "normal": (2, lambda rng, mean, stddev: rng.gauss(mean, stddev)),
+        "lognormal": (2, lambda rng, mu, sigma: rng.lognormvariate(mu, sigma)),
+        "exponential": (1, lambda rng, mean: rng.expovariate(1 / mean)),
+    }
+    if name not in distributions or len(values) != distributions[name][0]:
+        raise ValueError("Invalid latency distribution: %s" % spec)
+    function = distributions[name][1]
+    return lambda rng: max(0.0, function(rng, *values))
+
+
+class TokenBucket:
+    """Limita las solicitudes por segundo, esperando hasta tener un token"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def soap_response(element):
+    envelope = etree.Element(etree.QName(NS_SOAP, "Envelope"), nsmap={"soap": NS_SOAP})
+    body = etree.SubElement(envelope, etree.QName(NS_SOAP, "Body"))
+    body.append(element)
+    return etree.tostring(envelope, xml_declaration=True, encoding="UTF-8")
+
+
+def add_messages(parent, messages):
+    mensajes = etree.SubElement(parent, "mensajes")
+    for identificador, mensaje, tipo in messages:
+        node = etree.SubElement(mensajes, "mensaje")
+        etree.SubElement(node, "identificador").text = identificador
+        etree.SubElement(node, "mensaje").text = mensaje
+        etree.SubElement(node, "tipo").text = tipo
+
+
+class SriSimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._reply(200, json.dumps(self.server.info()).encode(), "application/json")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        status, response = self.server.dispatch(body)
+        self._reply(status, response, "text/xml; charset=utf-8")
+
+    def _reply(self, status, response, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+
+class SriSimulatorServer(ThreadingHTTPServer):
+    """
+    Servidor local con el mismo contrato SOAP que los webservices offline
+    del SRI, para pruebas de carga sin llamar a celcer.sri.gob.ec
+    Los comprobantes recibidos se autorizan luego de processing_time segundos,
+    antes de eso la autorizacion responde EN PROCESO
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        latency="fixed:0",
+        processing_time=0.0,
+        devuelta_rate=0.0,
+        rejected_rate=0.0,
+        error_rate=0.0,
+        max_rps=0,
+        seed=None,
+    ):
+        self.latency = parse_latency(latency)
+        self.processing_time = processing_time
+        self.devuelta_rate = devuelta_rate
+        self.rejected_rate = rejected_rate
+        self.error_rate = error_rate
+        self.throttle = max_rps and TokenBucket(max_rps) or None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # clave de acceso: (momento de recepcion, xml, estado final)
+        self.documents = {}
+        self.stats = Counter()
+        super().__init__(address, SriSimulatorHandler)
+
+    def _random_value(self, function):
+        with self._lock:
+            return function(self._random)
+
+    def dispatch(self, body):
+        if self.throttle:
+            self.throttle.acquire()
+        time.sleep(self._random_value(self.latency))
+        try:
+            request = etree.fromstring(body)
+            operation = request.find(f"{{{NS_SOAP}}}Body")[0]
+        except Exception as e:
+            return 500, self.fault(ustr(e))
+        name = etree.QName(operation).localname
+        with self._lock:
+            self.stats[name] += 1
+        if self._random_value(lambda rng: rng.random()) < self.error_rate:
+            with self._lock:
+                self.stats["errors"] += 1
+            return 500, self.fault("Simulated internal error")
+        if name == "validarComprobante":
+            return 200, self.validar_comprobante(operation.findtext("xml") or "")
+        if name == "autorizacionComprobante":
+            return 200, self.autorizacion_comprobante(
+                operation.findtext("claveAccesoComprobante") or ""
+            )
+        return 500, self.fault("Unknown operation %s" % name)
+
+    def fault(self, message):
+        fault = etree.Element(etree.QName(NS_SOAP, "Fault"))
+        etree.SubElement(fault, "faultcode").text = "soap:Server"
+        etree.SubElement(fault, "faultstring").text = message
+        return soap_response(fault)
+
+    def validar_comprobante(self, xml_base64):
+        messages = []
+        access_key = ""
+        try:
+            xml = base64.b64decode(xml_base64)
+            access_key = etree.fromstring(xml).findtext("infoTributaria/claveAcceso")
+        except Exception:
+            xml = b""
+        with self._lock:
+            if not access_key:
+                messages.append(("35", "ARCHIVO NO CUMPLE ESTRUCTURA XML", "ERROR"))
+            elif access_key in self.documents:
+                messages.append(("43", "CLAVE ACCESO REGISTRADA", "ERROR"))
+            elif self._random.random() < self.devuelta_rate:
+                messages.append(("35", "ARCHIVO NO CUMPLE ESTRUCTURA XML", "ERROR"))
+            else:
+                state = "AUTORIZADO"
+                if self._random.random() < self.rejected_rate:
+                    state = "NO AUTORIZADO"
+                self.documents[access_key] = (time.monotonic(), xml, state)
+            estado = messages and "DEVUELTA" or "RECIBIDA"
+            self.stats[estado] += 1
+        response = etree.Element(
+            etree.QName(NS_RECEPTION, "validarComprobanteResponse"),
+            nsmap={"ns2": NS_RECEPTION},
+        )
+        respuesta = etree.SubElement(response, "RespuestaRecepcionComprobante")
+        etree.SubElement(respuesta, "estado").text = estado
+        comprobantes = etree.SubElement(respuesta, "comprobantes")
+        if messages:
+            comprobante = etree.SubElement(comprobantes, "comprobante")
+            etree.SubElement(comprobante, "claveAcceso").text = access_key
+            add_messages(comprobante, messages)
+        return soap_response(response)
+
+    def autorizacion_comprobante(self, access_key):
+        with self._lock:
+            document = self.documents.get(access_key)
+            state = False
+            if document:
+                received_at, xml, state = document
+                if time.monotonic() - received_at < self.processing_time:
+                    state = "EN PROCESO"
+                self.stats[state] += 1
+        response = etree.Element(
+            etree.QName(NS_AUTHORIZATION, "autorizacionComprobanteResponse"),
+            nsmap={"ns2": NS_AUTHORIZATION},
+        )
+        respuesta = etree.SubElement(response, "RespuestaAutorizacionComprobante")
+        etree.SubElement(respuesta, "claveAccesoConsultada").text = access_key
+        etree.SubElement(respuesta, "numeroComprobantes").text = str(int(bool(state)))
+        autorizaciones = etree.SubElement(respuesta, "autorizaciones")
+        if state:
+            autorizacion = etree.SubElement(autorizaciones, "autorizacion")
+            etree.SubElement(autorizacion, "estado").text = state
+            if state == "AUTORIZADO":
+                etree.SubElement(autorizacion, "numeroAutorizacion").text = access_key
+                etree.SubElement(autorizacion, "fechaAutorizacion").text = datetime.now(
+                    SRI_TIMEZONE
+                ).isoformat(timespec="seconds")
+            etree.SubElement(autorizacion, "ambiente").text = "PRUEBAS"
+            etree.SubElement(autorizacion, "comprobante").text = xml.decode()
+            messages = []
+            if state == "NO AUTORIZADO":
+                messages.append(("56", "ERROR ESTABLECIMIENTO CERRADO", "ERROR"))
+            add_messages(autorizacion, messages)
+        return soap_response(response)
+
+    def info(self):
+        with self._lock:
+            res = dict(self.stats)
+            res["documents"] = len(self.documents)
+        return res
+
+
+class SriSimulator(Command):
+    """Start a local simulator of the SRI offline web services
+
+    odoo-bin --addons-path=... srisimulator --port 8099 --latency uniform:0.1:0.4
+
+    Then point the test environment to it with the system parameters
+    l10n_ec_sri_test_reception_url and l10n_ec_sri_test_authorization_url
+    (http://localhost:8099/). GET on any path returns the statistics.
+    """
+
+    def run(self, args):
+        parser = argparse.ArgumentParser(
+            prog="odoo-bin srisimulator",
+            description="Local simulator of the SRI offline web services",
+        )
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8099)
+        parser.add_argument(
+            "--latency",
+            default="fixed:0",
+            help="fixed:S, uniform:MIN:MAX, normal:MEAN:STDDEV, "
+            "lognormal:MU:SIGMA or exponential:MEAN, in seconds",
+        )
+        parser.add_argument(
+            "--processing-time",
+            type=float,
+            default=0.0,
+            help="Seconds a received document stays EN PROCESO",
+        )
+        parser.add_argument(
+            "--devuelta-rate",
+            type=float,
+            default=0.0,
+            help="Fraction of documents returned as DEVUELTA",
+        )
+        parser.add_argument(
+            "--rejected-rate",
+            type=float,
+            default=0.0,
+            help="Fraction of documents answered as NO AUTORIZADO",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="Fraction of requests answered with an HTTP 500 error",
+        )
+        parser.add_argument(
+            "--max-rps",
+            type=float,
+            default=0,
+            help="Maximum requests per second, 0 for no limit",
+        )
+        parser.add_argument("--seed", type=int, help="Random seed")
+        opts = parser.parse_args(args)
+        odoo.netsvc.init_logger()
+        server = SriSimulatorServer(
+            (opts.host, opts.port),
+            latency=opts.latency,
+            processing_time=opts.processing_time,
+            devuelta_rate=opts.devuelta_rate,
+            rejected_rate=opts.rejected_rate,
+            error_rate=opts.error_rate,
+            max_rps=opts.max_rps,
+            seed=opts.seed,
+        )
+        _logger.info("SRI simulator listening on %s:%s", opts.host, opts.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            _logger.info("SRI simulator stopped, %s", server.info())
+        finally:
+            server.server_close()
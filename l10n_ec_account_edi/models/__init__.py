@@ -2,6 +2,7 @@ from . import account_move
 from . import account_move_line
 from . import account_edi_format
 from . import account_edi_document
+from . import ir_attachment
 from . import sri_key_type
 from . import res_company
 from . import res_config_settings
@@ -1,16 +1,28 @@
+import base64
+import fcntl
+import gzip
+import hashlib
+import json
 import logging
 import re
+import threading
+import time
 import traceback
-from datetime import datetime
+from contextlib import nullcontext
+from datetime import date, datetime
+from io import BytesIO
 from os import path
 from random import randint
 
 import pytz
+import requests
 from lxml import etree
+from zeep.exceptions import Fault, TransportError
 from zeep.helpers import serialize_object
 
 from odoo import _, api, fields, models, tools
 from odoo.exceptions import UserError
+from odoo.osv import expression
 from odoo.tools import DEFAULT_SERVER_DATETIME_FORMAT as DTF
 from odoo.tools.misc import remove_accents
 
@@ -18,6 +30,559 @@ _logger = logging.getLogger(__name__)
 
 EDI_DATE_FORMAT = "%d/%m/%Y"
 
+# prefijo del archivo xsd y campo de la compañia con la version del xml
+# segun el tipo de documento
+XSD_FILES_DATA = {
+    "invoice": ("factura", "l10n_ec_invoice_version"),
+    "purchase_liquidation": ("LiquidacionCompra", "l10n_ec_liquidation_version"),
+    "credit_note": ("NotaCredito", "l10n_ec_credit_note_version"),
+    "debit_note": ("NotaDebito", "l10n_ec_debit_note_version"),
+}
+
+# cache a nivel de proceso de los esquemas xsd compilados
+# clave: (tipo de documento, version), valor: (XMLSchema, Lock)
+# XMLSchema guarda el error_log en la misma instancia,
+# por eso cada esquema tiene su propio lock para validar desde varios hilos
+_xsd_schema_cache = {}
+_xsd_schema_cache_lock = threading.Lock()
+_xsd_schema_cache_stats = {"hits": 0, "misses": 0}
+
+
+class CircuitOpenError(Exception):
+    """El webservice del SRI no esta disponible, el circuito esta abierto"""
+
+
+class CircuitBreaker:
+    """
+    Deja de llamar a un webservice del SRI luego de varios errores de conexion
+    seguidos, para no esperar el timeout con cada documento.
+    Estados:
+        closed: se hacen las solicitudes normalmente
+        open: las solicitudes fallan de inmediato con CircuitOpenError
+        half_open: pasado el tiempo de espera, se permite una solicitud de prueba,
+            si funciona se cierra el circuito, caso contrario se abre nuevamente
+    """
+
+    # errores que indican que el webservice no esta disponible
+    FAILURE_EXCEPTIONS = (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        TransportError,
+    )
+
+    def __init__(self, name, failure_threshold=5, cool_down=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cool_down = cool_down
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            _logger.warning(
+                "Circuit breaker of SRI web service %s changed from %s to %s",
+                self.name,
+                self.state,
+                state,
+            )
+            self.state = state
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.cool_down:
+                    return False
+                self._set_state("half_open")
+            # en half_open solo una solicitud de prueba a la vez
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self._set_state("closed")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state("open")
+
+    def call(self, function, *args, **kwargs):
+        """
+        Llama a la funcion si el circuito lo permite,
+        registrando los errores de conexion
+        """
+        if not self.allow_request():
+            raise CircuitOpenError(self.name)
+        try:
+            response = function(*args, **kwargs)
+        except self.FAILURE_EXCEPTIONS:
+            self.record_failure()
+            raise
+        except Exception:
+            # el webservice respondio, por ejemplo con un soap fault
+            self.record_success()
+            raise
+        self.record_success()
+        return response
+
+
+class RateLimiter:
+    """
+    Limita las solicitudes por segundo a un webservice del SRI.
+    El estado se guarda en un archivo bloqueado con flock,
+    asi todos los workers y crons del servidor comparten el mismo limite.
+    Cada solicitud reserva su turno y espera fuera del bloqueo,
+    se permiten hasta burst solicitudes seguidas sin esperar
+    """
+
+    def __init__(self, path, rate, burst=1):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+
+    def reserve(self):
+        """
+        Reserva el siguiente turno
+        :return: segundos a esperar antes de hacer la solicitud
+        """
+        interval = 1 / self.rate
+        with open(self.path, "a+b") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            try:
+                next_time = float(state_file.read() or 0)
+            except ValueError:
+                next_time = 0
+            now = time.time()
+            next_time = max(next_time, now) + interval
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(repr(next_time).encode())
+        return max(0.0, next_time - now - self.burst * interval)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def parse_soap_fault(content):
+    """
+    :return: zeep Fault con el mensaje del SOAP Fault de la respuesta,
+        None si la respuesta no es un SOAP Fault
+    """
+    parser = etree.XMLParser(resolve_entities=False, no_network=True)
+    try:
+        root = etree.fromstring(content, parser)
+    except (etree.XMLSyntaxError, ValueError):
+        return None
+    fault = root.find("{*}Body/{*}Fault")
+    if fault is None:
+        return None
+    return Fault(
+        message=fault.findtext("{*}faultstring") or "",
+        code=fault.findtext("{*}faultcode"),
+        detail=fault.find("{*}detail"),
+    )
+
+
+def check_xsd(xmlschema, xml_doc, schema_lock=None):
+    """
+    Valida el xml contra el esquema xsd compilado, sin usar el ORM,
+    usado en el proceso principal y en los procesos de firma
+    :param xml_doc: etree._Element ya parseado
+    :param schema_lock: Lock del esquema cuando se comparte entre hilos
+    :return: str con el error, False si el xml es valido
+    """
+    with schema_lock or nullcontext():
+        if xmlschema.validate(xml_doc):
+            return False
+        try:
+            xmlschema.assert_(xml_doc)
+        except AssertionError as e:
+            return tools.ustr(e)
+    return False
+
+
+def fault_record(fault):
+    """
+    Convierte un SOAP Fault en un comprobante con error,
+    con la misma estructura de las respuestas del SRI,
+    para mostrar el mensaje del SRI como los demas errores
+    """
+    return {
+        "estado": "ERROR",
+        "mensajes": {
+            "mensaje": [
+                {
+                    "identificador": fault.code or "",
+                    "mensaje": fault.message,
+                    "tipo": "ERROR",
+                }
+            ]
+        },
+    }
+
+
+def call_ws(client_ws, operation, rate_limiter=None, **kwargs):
+    """
+    Llama a la operacion del webservice, a traves del circuit breaker
+    del cliente si lo tiene, esperando el turno del limitador de solicitudes
+    Con clientes zeep devuelve el xml de la respuesta sin procesar,
+    para leerlo con parse_raw_response en lugar de crear todos los objetos
+    """
+    service_function = getattr(client_ws.service, operation)
+
+    def function(**kwargs):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        settings = getattr(client_ws, "settings", None)
+        if settings is None:
+            return service_function(**kwargs)
+        # la configuracion de zeep es por hilo
+        with settings(raw_response=True):
+            response = service_function(**kwargs)
+        if response.status_code != 200:
+            # el SRI responde los errores como SOAP Fault con estado 500,
+            # no es un error de conexion, mostrar el mensaje del SRI
+            fault = parse_soap_fault(response.content)
+            if fault is not None:
+                raise fault
+            raise TransportError(
+                status_code=response.status_code, content=response.content
+            )
+        return response.content
+
+    breaker = getattr(client_ws, "circuit_breaker", None)
+    if breaker is None:
+        return function(**kwargs)
+    return breaker.call(function, **kwargs)
+
+
+def edi_send_xml(client_ws, access_key, xml_file, rate_limiter=None):
+    """
+    Enviar a validar el comprobante con la clave de acceso,
+    no usa el ORM para poder llamarse desde varios hilos
+    :param client_ws: instancia del webservice para realizar el proceso
+    :param access_key: clave de acceso del comprobante
+    :param xml_file: bytes(o str) con el xml firmado
+    :param rate_limiter: RateLimiter de la recepcion para la compañia
+    """
+    response = False
+    try:
+        # el parametro xml del webservice espera recibir xs:base64Binary
+        # con suds nosotros haciamos la conversion
+        # pero con zeep la libreria se encarga de hacer la conversion
+        # tenerlo presente cuando se use adjuntos en lugar del sistema de archivos
+        if isinstance(xml_file, str):
+            xml_file = xml_file.encode()
+        response = call_ws(
+            client_ws, "validarComprobante", rate_limiter=rate_limiter, xml=xml_file
+        )
+        if isinstance(response, bytes):
+            estado = parse_raw_response(response, "comprobante")[0]
+        else:
+            estado = getattr(response, "estado", None)
+        _logger.info(
+            "Send file succesful, claveAcceso %s. %s",
+            access_key,
+            estado or "SIN RESPUESTA",
+        )
+    except CircuitOpenError:
+        raise
+    except Fault as e:
+        _logger.info("SOAP Fault sending claveAcceso %s: %s", access_key, e.message)
+        response = {
+            "estado": "DEVUELTA",
+            "comprobantes": {"comprobante": [fault_record(e)]},
+        }
+    except Exception as e:
+        _logger.info(
+            "can't validate document in %s, claveAcceso %s. ERROR: %s TRACEBACK: %s",
+            str(client_ws),
+            access_key,
+            tools.ustr(e),
+            tools.ustr(traceback.format_exc()),
+        )
+    return response
+
+
+def edi_send_xml_auth(client_ws, access_key, rate_limiter=None):
+    """
+    Envia a autorizar el archivo, no usa el ORM
+    :param client_ws: direccion del webservice para realizar el proceso
+    :param access_key: clave de acceso del comprobante
+    :param rate_limiter: RateLimiter de la autorizacion para la compañia
+    """
+    try:
+        response = call_ws(
+            client_ws,
+            "autorizacionComprobante",
+            rate_limiter=rate_limiter,
+            claveAccesoComprobante=access_key,
+        )
+    except CircuitOpenError:
+        raise
+    except Fault as e:
+        _logger.warning(
+            "SOAP Fault authorizing claveAcceso %s: %s", access_key, e.message
+        )
+        response = {"autorizaciones": {"autorizacion": [fault_record(e)]}}
+    except Exception as e:
+        response = False
+        _logger.warning(
+            "Error send xml to server %s. ERROR: %s", client_ws, tools.ustr(e)
+        )
+    return response
+
+
+def parse_raw_response(content, record_tag):
+    """
+    Recorre la respuesta SOAP del SRI con iterparse, liberando los nodos leidos,
+    y devuelve solo los datos necesarios, con la misma estructura que
+    serialize_object para procesarla de la misma manera
+    :param content: bytes con el xml de la respuesta
+    :param record_tag: comprobante para la recepcion, autorizacion para la autorizacion
+    :return: tuple(estado de la respuesta, lista de dict por cada record_tag
+        con estado, fechaAutorizacion, mensajes,
+        y numeroAutorizacion y comprobante si fue autorizado)
+    """
+    estado = False
+    records = []
+    # respuesta recibida por la red, sin resolver entidades ni accesos a la red
+    for _event, element in etree.iterparse(
+        BytesIO(content),
+        events=("end",),
+        huge_tree=True,
+        resolve_entities=False,
+        no_network=True,
+    ):
+        name = etree.QName(element).localname
+        if name == "estado" and element.getparent() is not None:
+            parent_name = etree.QName(element.getparent()).localname
+            if parent_name == "RespuestaRecepcionComprobante":
+                estado = element.text
+        elif name == record_tag and len(element):
+            fecha = element.findtext("{*}fechaAutorizacion")
+            try:
+                fecha = fecha and datetime.fromisoformat(fecha)
+            except ValueError:
+                fecha = False
+            records.append(
+                {
+                    "estado": element.findtext("{*}estado"),
+                    "fechaAutorizacion": fecha,
+                    "mensajes": {
+                        "mensaje": [
+                            {
+                                field: msj.findtext("{*}%s" % field)
+                                for field in (
+                                    "identificador",
+                                    "mensaje",
+                                    "informacionAdicional",
+                                    "tipo",
+                                )
+                            }
+                            for msj in element.iterfind("{*}mensajes/{*}mensaje")
+                        ]
+                    },
+                }
+            )
+            # el comprobante solo se conserva si fue autorizado
+            if records[-1]["estado"] == "AUTORIZADO":
+                records[-1]["numeroAutorizacion"] = element.findtext(
+                    "{*}numeroAutorizacion"
+                )
+                records[-1]["comprobante"] = element.findtext("{*}comprobante")
+            element.clear()
+    return estado, records
+
+
+def parse_response_send(response, access_key=""):
+    """
+    Procesa la respuesta de la recepcion del SRI
+    si fue devuelta, devolver False los mensajes
+    si fue recibida, devolver True y los mensajes
+    """
+    msj_list = []
+    if isinstance(response, bytes):
+        estado, comprobantes = parse_raw_response(response, "comprobante")
+        response_data = {
+            "estado": estado,
+            "comprobantes": {"comprobante": comprobantes},
+        }
+    else:
+        response_data = serialize_object(response, dict)
+    ok = response_data.get("estado", "") == "RECIBIDA"
+    if response_data.get("estado", "") == "DEVUELTA":
+        # si fue devuelta intentar nuevamente
+        ok = False
+    try:
+        comprobantes = (response_data.get("comprobantes") or {}).get(
+            "comprobante"
+        ) or []
+        for comprobante in comprobantes:
+            mensajes = (comprobante.get("mensajes") or {}).get("mensaje") or []
+            for msj in mensajes:
+                if msj.get("tipo") == "ERROR":
+                    ok = False
+                msj_str = "%s [%s] %s %s" % (
+                    msj.get("tipo") or "",
+                    msj.get("identificador") or "",
+                    msj.get("mensaje") or "",
+                    msj.get("informacionAdicional") or "",
+                )
+                msj_list.append(msj_str)
+    except Exception as e:
+        msj_list.append(tools.ustr(e))
+        _logger.info(
+            "can't validate document, claveAcceso %s. ERROR: %s TRACEBACK: %s",
+            access_key,
+            tools.ustr(e),
+            tools.ustr(traceback.format_exc()),
+        )
+        ok = False
+    return ok, msj_list
+
+
+def parse_response_auth(response):
+    """
+    Procesa la respuesta de la autorizacion del SRI
+    :return: tuple(autorizado, mensajes, fecha de autorizacion en UTC,
+        dict con numeroAutorizacion y comprobante autorizado)
+    """
+    ok = False
+    msj_list = []
+    l10n_ec_authorization_date = False
+    authorization = {}
+    if isinstance(response, bytes):
+        autorizaciones = parse_raw_response(response, "autorizacion")[1]
+        response_data = {
+            "autorizaciones": autorizaciones and {"autorizacion": autorizaciones}
+        }
+    else:
+        response_data = serialize_object(response, dict)
+    if not response_data or not response_data.get("autorizaciones"):
+        _logger.warning("Authorization response error, No Autorizacion in response")
+        return ok, msj_list, l10n_ec_authorization_date, authorization
+    # a veces el SRI devulve varias autorizaciones, unas como no autorizadas
+    # pero otra si autorizada, si pasa eso, tomar la que fue autorizada
+    # las demas ignorarlas
+    autorizacion_list = response_data.get("autorizaciones").get("autorizacion")
+    if not isinstance(autorizacion_list, list):
+        autorizacion_list = [autorizacion_list]
+    for doc in autorizacion_list:
+        mensajes = (doc.get("mensajes") or {}).get("mensaje") or []
+        for msj in mensajes:
+            msj_str = "%s [%s] %s %s" % (
+                msj.get("tipo") or "",
+                msj.get("identificador") or "",
+                msj.get("mensaje") or "",
+                msj.get("informacionAdicional") or "",
+            )
+            msj_list.append(msj_str)
+        estado = doc.get("estado")
+        if estado != "AUTORIZADO":
+            ok = False
+            continue
+        ok = True
+        msj_list = []
+        # tomar la fecha de autorizacion que envia el SRI
+        l10n_ec_authorization_date = doc.get("fechaAutorizacion")
+        # si no es una fecha valida, tomar la fecha actual del sistema
+        if not isinstance(l10n_ec_authorization_date, datetime):
+            l10n_ec_authorization_date = datetime.now()
+        if l10n_ec_authorization_date.tzinfo:
+            l10n_ec_authorization_date = l10n_ec_authorization_date.astimezone(pytz.UTC)
+        authorization = {
+            "numeroAutorizacion": doc.get("numeroAutorizacion"),
+            "comprobante": doc.get("comprobante"),
+        }
+        break
+    return ok, msj_list, l10n_ec_authorization_date, authorization
+
+
+def has_authorizations(response):
+    """
+    Indica si la respuesta de la autorizacion contiene el comprobante,
+    en cualquier estado(EN PROCESO, AUTORIZADO, NO AUTORIZADO)
+    """
+    if isinstance(response, bytes):
+        return bool(parse_raw_response(response, "autorizacion")[1])
+    response_data = serialize_object(response, dict)
+    return bool(response_data and response_data.get("autorizaciones"))
+
+
+def edi_submit_document(
+    client_send,
+    auth_client,
+    access_key,
+    xml_file,
+    check_auth,
+    authorize=True,
+    send_limiter=None,
+    auth_limiter=None,
+    received=False,
+):
+    """
+    Envia el comprobante al SRI y solicita su autorizacion,
+    solo hace llamadas a los webservices, sin usar el ORM,
+    para poder enviar varios comprobantes al mismo tiempo desde varios hilos
+    :param check_auth: consultar primero si el comprobante ya fue autorizado
+    :param authorize: consultar la autorizacion luego de enviarlo,
+        si es False se debe consultar despues con edi_send_xml_auth
+    :param send_limiter: RateLimiter de la recepcion
+    :param auth_limiter: RateLimiter de la autorizacion
+    :param received: el SRI ya recibio el comprobante en un intento anterior,
+        solo se consulta la autorizacion, se reenvia si el SRI no lo encuentra
+    :return: dict con las respuestas del SRI
+        auth_before: autorizacion consultada antes del envio
+        send: respuesta de la recepcion
+        sent_date: fecha de envio, si el comprobante fue recibido
+        auth: autorizacion consultada despues del envio
+        send_skipped: no se envio porque el SRI ya lo tenia recibido
+    """
+    result = {
+        "auth_before": False,
+        "send": False,
+        "sent_date": False,
+        "auth": False,
+        "send_skipped": False,
+    }
+    if check_auth or received:
+        result["auth_before"] = edi_send_xml_auth(auth_client, access_key, auth_limiter)
+        if parse_response_auth(result["auth_before"])[0]:
+            return result
+        # reenviarlo devolveria CLAVE ACCESO REGISTRADA,
+        # sin respuesta del SRI se consultara nuevamente en el siguiente intento
+        if received and (
+            not result["auth_before"] or has_authorizations(result["auth_before"])
+        ):
+            result["send_skipped"] = True
+            return result
+    result["send"] = edi_send_xml(client_send, access_key, xml_file, send_limiter)
+    if not result["send"]:
+        return result
+    ok, msj = parse_response_send(result["send"], access_key)
+    if ok and not msj:
+        result["sent_date"] = datetime.now()
+        if authorize:
+            result["auth"] = edi_send_xml_auth(auth_client, access_key, auth_limiter)
+    return result
+
 
 class AccountEdiDocument(models.Model):
     _inherit = "account.edi.document"
@@ -31,6 +596,44 @@ class AccountEdiDocument(models.Model):
     l10n_ec_last_sent_date = fields.Datetime(
         "Last Sent Date", readonly=True, index=True
     )
+    l10n_ec_authorization_number = fields.Char(
+        "Authorization Number", readonly=True, copy=False
+    )
+    l10n_ec_authorized_xml = fields.Binary(
+        "Authorized XML",
+        attachment=True,
+        readonly=True,
+        copy=False,
+        help="XML authorized by SRI, compressed with gzip",
+    )
+    l10n_ec_authorized_xml_filename = fields.Char(
+        compute="_compute_l10n_ec_authorized_xml_filename"
+    )
+    l10n_ec_edi_stage = fields.Selection(
+        [
+            ("signed", "Signed"),
+            ("received", "Received by SRI"),
+            ("authorized", "Authorized"),
+        ],
+        string="EDI Stage",
+        readonly=True,
+        copy=False,
+        help="Last completed stage of the submission to SRI, "
+        "a new attempt continues from this stage",
+    )
+    l10n_ec_signed_xml_hash = fields.Char(
+        "Signed XML Hash",
+        readonly=True,
+        copy=False,
+        help="SHA-256 of the signed XML, to reuse it on a new attempt",
+    )
+    l10n_ec_render_hash = fields.Char(
+        "Render Data Hash",
+        readonly=True,
+        copy=False,
+        help="SHA-256 of the data used to generate the XML, "
+        "while it does not change the signed XML is reused",
+    )
     l10n_ec_document_number = fields.Char(
         string="Document Number", compute="_compute_l10n_ec_document_data", store=True
     )
@@ -46,6 +649,13 @@ class AccountEdiDocument(models.Model):
         store=True,
     )
 
+    @api.depends("l10n_ec_xml_access_key")
+    def _compute_l10n_ec_authorized_xml_filename(self):
+        for edi_doc in self:
+            edi_doc.l10n_ec_authorized_xml_filename = (
+                f"{edi_doc.l10n_ec_xml_access_key}.xml.gz"
+            )
+
     @api.depends("move_id")
     def _compute_l10n_ec_document_data(self):
         for edi_doc in self:
@@ -135,47 +745,117 @@ class AccountEdiDocument(models.Model):
         )
 
     def _l10n_ec_action_check_xsd(self, xml_string):
-        try:
-            xsd_file_path = self._l10n_ec_get_xsd_filename()
-            xsd_file = tools.file_open(xsd_file_path)
-            xmlschema_doc = etree.parse(xsd_file)
-            xmlschema = etree.XMLSchema(xmlschema_doc)
+        """
+        Valida el xml contra el esquema xsd
+        :param xml_string: str con el xml o etree._Element ya parseado
+        """
+        xmlschema, schema_lock = self._l10n_ec_get_xsd_schema()
+        xml_doc = xml_string
+        if not etree.iselement(xml_doc):
             xml_doc = etree.fromstring(xml_string)
-            result = xmlschema.validate(xml_doc)
-            if not result:
-                xmlschema.assert_(xml_doc)
-            return result
-        except AssertionError as e:
-            if self.env.context.get("l10n_ec_xml_call_from_cron") or tools.config.get(
-                "skip_xsd_check", False
-            ):
-                _logger.error(
-                    "Wrong XML File, access_key: %s, Error: %s",
-                    self.l10n_ec_xml_access_key,
-                    tools.ustr(e),
-                )
-            else:
-                raise UserError(
-                    _("Wrong XML File, Detail: \n%s") % tools.ustr(e)
-                ) from None
+        error = check_xsd(xmlschema, xml_doc, schema_lock)
+        if not error:
+            return True
+        if self._l10n_ec_raise_xsd_error():
+            raise UserError(_("Wrong XML File, Detail: \n%s") % error)
+        _logger.error(
+            "Wrong XML File, access_key: %s, Error: %s",
+            self.l10n_ec_xml_access_key,
+            error,
+        )
         return True
 
-    def _l10n_ec_get_xsd_filename(self):
-        filename = ""
-        base_path = path.join("l10n_ec_account_edi", "data", "xsd")
+    @api.model
+    def _l10n_ec_raise_xsd_error(self):
+        """
+        Indica si un xml que no cumple el esquema xsd debe detener el envio,
+        desde el cron o con skip_xsd_check solo se registra el error
+        """
+        return not (
+            self.env.context.get("l10n_ec_xml_call_from_cron")
+            or tools.config.get("skip_xsd_check", False)
+        )
+
+    def _l10n_ec_get_xsd_key(self):
+        """
+        Devuelve la clave del esquema xsd a usar para validar el documento
+        :return: tuple(tipo de documento, version del xml)
+        """
         company = self.move_id.company_id or self.env.company
         document_type = self._l10n_ec_get_document_type()
-        if document_type == "invoice":
-            filename = f"factura_V{company.l10n_ec_invoice_version}"
-        if document_type == "purchase_liquidation":
-            filename = f"LiquidacionCompra_V{company.l10n_ec_liquidation_version}"
-        if document_type == "credit_note":
-            filename = f"NotaCredito_V{company.l10n_ec_credit_note_version}"
-        if document_type == "debit_note":
-            filename = f"NotaDebito_V{company.l10n_ec_debit_note_version}"
+        version = ""
+        if document_type in XSD_FILES_DATA:
+            version = company[XSD_FILES_DATA[document_type][1]]
         # TODO: agregar logica para demas tipos de documento
+        return document_type, version
+
+    def _l10n_ec_get_xsd_filename(self):
+        return self._l10n_ec_get_xsd_filename_from_key(*self._l10n_ec_get_xsd_key())
+
+    @api.model
+    def _l10n_ec_get_xsd_filename_from_key(self, document_type, version):
+        filename = ""
+        base_path = path.join("l10n_ec_account_edi", "data", "xsd")
+        if document_type in XSD_FILES_DATA:
+            filename = f"{XSD_FILES_DATA[document_type][0]}_V{version}"
         return path.join(base_path, f"{filename}.xsd")
 
+    def _l10n_ec_get_xsd_schema(self):
+        """
+        Devuelve el esquema xsd compilado desde la cache del proceso,
+        compilandolo la primera vez que se solicita
+        :return: tuple(XMLSchema, Lock)
+        """
+        return self._l10n_ec_get_xsd_schema_from_key(*self._l10n_ec_get_xsd_key())
+
+    @api.model
+    def _l10n_ec_get_xsd_schema_from_key(self, document_type, version):
+        key = (document_type, version)
+        with _xsd_schema_cache_lock:
+            cached = _xsd_schema_cache.get(key)
+            if cached is not None:
+                _xsd_schema_cache_stats["hits"] += 1
+                return cached
+            _xsd_schema_cache_stats["misses"] += 1
+            # compilar dentro del lock,
+            # asi varios hilos no compilan el mismo esquema a la vez
+            xsd_file_path = self._l10n_ec_get_xsd_filename_from_key(*key)
+            with tools.file_open(xsd_file_path, "rb") as xsd_file:
+                xmlschema = etree.XMLSchema(etree.parse(xsd_file))
+            cached = (xmlschema, threading.Lock())
+            _xsd_schema_cache[key] = cached
+        _logger.debug("XSD schema %s compiled and cached", xsd_file_path)
+        return cached
+
+    @api.model
+    def _l10n_ec_load_xsd_schemas(self):
+        """
+        Precompila los esquemas xsd de las versiones configuradas en las compañias
+        """
+        companies = self.env["res.company"].sudo().search([])
+        for document_type, (_prefix, version_field) in XSD_FILES_DATA.items():
+            for version in set(companies.mapped(version_field)):
+                if not version:
+                    continue
+                try:
+                    self._l10n_ec_get_xsd_schema_from_key(document_type, version)
+                except Exception as e:
+                    _logger.warning(
+                        "Can't load XSD schema for %s version %s. Error: %s",
+                        document_type,
+                        version,
+                        tools.ustr(e),
+                    )
+
+    @api.model
+    def _l10n_ec_get_xsd_cache_info(self):
+        """
+        Estadisticas de la cache de esquemas xsd del proceso actual
+        :return: dict con hits, misses y size
+        """
+        with _xsd_schema_cache_lock:
+            return dict(_xsd_schema_cache_stats, size=len(_xsd_schema_cache))
+
     def _l10n_ec_get_info_tributaria(self, document):
         company = document.company_id
         document_code_sri = self._l10n_ec_get_edi_code_sri()
@@ -326,31 +1006,95 @@ class AccountEdiDocument(models.Model):
         else:
             return "0.00"
 
-    def _l10n_ec_render_xml_edi(self):
-        ViewModel = self.env["ir.ui.view"].sudo()
+    def _l10n_ec_get_xml_edi_render_data(self):
+        """
+        Devuelve la plantilla y los datos para generar el xml del documento
+        :return: tuple(xml_id de la plantilla, dict con los datos)
+            o tuple(False, {}) si el tipo de documento no esta soportado
+        """
         document_type = self._l10n_ec_get_document_type()
-        xml_file = ""
         if document_type == "invoice":
-            xml_file = ViewModel._render_template(
-                "l10n_ec_account_edi.ec_edi_invoice", self._l10n_ec_get_info_invoice()
+            return (
+                "l10n_ec_account_edi.ec_edi_invoice",
+                self._l10n_ec_get_info_invoice(),
             )
         if document_type == "purchase_liquidation":
-            xml_file = ViewModel._render_template(
+            return (
                 "l10n_ec_account_edi.ec_edi_liquidation",
                 self._l10n_ec_get_info_liquidation(),
             )
         if document_type == "credit_note":
-            xml_file = ViewModel._render_template(
+            return (
                 "l10n_ec_account_edi.ec_edi_credit_note",
                 self._l10n_ec_get_info_credit_note(),
             )
         if document_type == "debit_note":
-            xml_file = ViewModel._render_template(
+            return (
                 "l10n_ec_account_edi.ec_edi_debit_note",
                 self._l10n_ec_get_info_debit_note(),
             )
         # TODO: agregar logica para demas tipos de documento
-        return xml_file
+        return False, {}
+
+    def _l10n_ec_render_xml_edi(self, render_data=None):
+        """
+        :param render_data: tuple(plantilla, datos) de _l10n_ec_get_xml_edi_render_data
+            para no volver a calcular los datos
+        """
+        template, values = render_data or self._l10n_ec_get_xml_edi_render_data()
+        if not template:
+            return ""
+        return self.env["ir.ui.view"].sudo()._render_template(template, values)
+
+    def _l10n_ec_render_xml_edi_tree(self, render_data=None):
+        """
+        Devuelve el xml del documento ya parseado,
+        para validarlo y firmarlo sin volver a parsearlo
+        :return: etree._Element
+        """
+        return etree.fromstring(self._l10n_ec_render_xml_edi(render_data))
+
+    @api.model
+    def _l10n_ec_get_render_hash(self, render_data):
+        """
+        Hash de los datos con los que se genera el xml,
+        independiente del orden de las claves y sin la firma,
+        mismos datos generan el mismo xml
+        Incluye la version del xml de la company, el certificado de firma
+        y la plantilla, cambiar cualquiera genera el xml nuevamente
+        :param render_data: tuple(plantilla, datos) de _l10n_ec_get_xml_edi_render_data
+        :return: str con el SHA-256 en hexadecimal
+        """
+        self.ensure_one()
+        template, values = render_data
+        company = self.move_id.company_id or self.env.company
+        template_data = False
+        if template:
+            view = self.env.ref(template).sudo()
+            views = view | view.inherit_children_ids
+            template_data = [
+                view.arch_db,
+                max(views.mapped("write_date")),
+            ]
+        payload = [
+            template,
+            values,
+            self._l10n_ec_get_xsd_key(),
+            company.l10n_ec_key_type_id.content_checksum,
+            template_data,
+        ]
+
+        def to_json(value):
+            if isinstance(value, models.BaseModel):
+                return [value._name, value.ids]
+            if isinstance(value, (date, datetime)):
+                return value.isoformat()
+            return str(value)
+
+        content = json.dumps(
+            payload, sort_keys=True, separators=(",", ":"), default=to_json
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
 
     def _l10n_ec_get_info_aditional(self):
         info_data = [
@@ -512,28 +1256,9 @@ class AccountEdiDocument(models.Model):
         """
         Enviar a validar el comprobante con la clave de acceso
         :param client_ws: instancia del webservice para realizar el proceso
+        :param xml_file: bytes(o str) con el xml firmado
         """
-        response = False
-        try:
-            # el parametro xml del webservice espera recibir xs:base64Binary
-            # con suds nosotros haciamos la conversion
-            # pero con zeep la libreria se encarga de hacer la conversion
-            # tenerlo presente cuando se use adjuntos en lugar del sistema de archivos
-            response = client_ws.service.validarComprobante(xml=xml_file.encode())
-            _logger.info(
-                "Send file succesful, claveAcceso %s. %s",
-                self.l10n_ec_xml_access_key,
-                getattr(response, "estado", "SIN RESPUESTA"),
-            )
-        except Exception as e:
-            _logger.info(
-                "can't validate document in %s, claveAcceso %s. ERROR: %s TRACEBACK: %s",
-                str(client_ws),
-                self.l10n_ec_xml_access_key,
-                tools.ustr(e),
-                tools.ustr(traceback.format_exc()),
-            )
-        return response
+        return edi_send_xml(client_ws, self.l10n_ec_xml_access_key, xml_file)
 
     def _l10n_ec_edi_process_response_send(self, response):
         """
@@ -541,54 +1266,14 @@ class AccountEdiDocument(models.Model):
         si fue devuelta, devolver False los mensajes
         si fue recibida, devolver True y los mensajes
         """
-        msj_list = []
-        response_data = serialize_object(response, dict)
-        ok = response_data.get("estado", "") == "RECIBIDA"
-        if response_data.get("estado", "") == "DEVUELTA":
-            # si fue devuelta intentar nuevamente
-            ok = False
-        try:
-            comprobantes = (response_data.get("comprobantes") or {}).get(
-                "comprobante"
-            ) or []
-            for comprobante in comprobantes:
-                mensajes = (comprobante.get("mensajes") or {}).get("mensaje") or []
-                for msj in mensajes:
-                    if msj.get("tipo") == "ERROR":
-                        ok = False
-                    msj_str = "%s [%s] %s %s" % (
-                        msj.get("tipo") or "",
-                        msj.get("identificador") or "",
-                        msj.get("mensaje") or "",
-                        msj.get("informacionAdicional") or "",
-                    )
-                    msj_list.append(msj_str)
-        except Exception as e:
-            msj_list.append(tools.ustr(e))
-            _logger.info(
-                "can't validate document, claveAcceso %s. ERROR: %s TRACEBACK: %s",
-                self.l10n_ec_xml_access_key,
-                tools.ustr(e),
-                tools.ustr(traceback.format_exc()),
-            )
-            ok = False
-        return ok, msj_list
+        return parse_response_send(response, self.l10n_ec_xml_access_key)
 
     def _l10n_ec_edi_send_xml_auth(self, client_ws):
         """
         Envia a autorizar el archivo
         :param client_ws: direccion del webservice para realizar el proceso
         """
-        try:
-            response = client_ws.service.autorizacionComprobante(
-                claveAccesoComprobante=self.l10n_ec_xml_access_key
-            )
-        except Exception as e:
-            response = False
-            _logger.warning(
-                "Error send xml to server %s. ERROR: %s", client_ws, tools.ustr(e)
-            )
-        return response
+        return edi_send_xml_auth(client_ws, self.l10n_ec_xml_access_key)
 
     def _l10n_ec_edi_process_response_auth(self, response):
         """
@@ -596,54 +1281,270 @@ class AccountEdiDocument(models.Model):
         si fue devuelta, devolver False los mensajes
         si fue recibida, devolver True y los mensajes
         """
-        ok = False
-        msj_list = []
-        response_data = serialize_object(response, dict)
-        if not response_data or not response_data.get("autorizaciones"):
-            _logger.warning("Authorization response error, No Autorizacion in response")
-            return ok, msj_list
-        # a veces el SRI devulve varias autorizaciones, unas como no autorizadas
-        # pero otra si autorizada, si pasa eso, tomar la que fue autorizada
-        # las demas ignorarlas
-        autorizacion_list = response_data.get("autorizaciones").get("autorizacion")
-        if not isinstance(autorizacion_list, list):
-            autorizacion_list = [autorizacion_list]
-        for doc in autorizacion_list:
-            mensajes = (doc.get("mensajes") or {}).get("mensaje") or []
-            for msj in mensajes:
-                msj_str = "%s [%s] %s %s" % (
-                    msj.get("tipo") or "",
-                    msj.get("identificador") or "",
-                    msj.get("mensaje") or "",
-                    msj.get("informacionAdicional") or "",
-                )
-                msj_list.append(msj_str)
-            estado = doc.get("estado")
-            if estado != "AUTORIZADO":
-                ok = False
-                continue
-            ok = True
-            msj_list = []
-            # tomar la fecha de autorizacion que envia el SRI
-            l10n_ec_authorization_date = doc.get("fechaAutorizacion")
-            # si no es una fecha valida, tomar la fecha actual del sistema
-            if not isinstance(l10n_ec_authorization_date, datetime):
-                l10n_ec_authorization_date = datetime.now()
-            if l10n_ec_authorization_date.tzinfo:
-                l10n_ec_authorization_date = l10n_ec_authorization_date.astimezone(
-                    pytz.UTC
-                )
+        ok, msj_list, l10n_ec_authorization_date, authorization = parse_response_auth(
+            response
+        )
+        if ok:
             _logger.info(
                 "Authorization succesful, claveAcceso %s. Fecha de autorizacion: %s",
                 self.l10n_ec_xml_access_key,
                 l10n_ec_authorization_date,
             )
-            self.write(
-                {"l10n_ec_authorization_date": l10n_ec_authorization_date.strftime(DTF)}
-            )
-            break
+            vals = {
+                "l10n_ec_edi_stage": "authorized",
+                "l10n_ec_authorization_date": l10n_ec_authorization_date.strftime(DTF),
+                "l10n_ec_authorization_number": authorization.get("numeroAutorizacion"),
+            }
+            # guardar el xml autorizado comprimido,
+            # para no consultarlo nuevamente al SRI
+            authorized_xml = authorization.get("comprobante")
+            if authorized_xml:
+                vals["l10n_ec_authorized_xml"] = base64.b64encode(
+                    gzip.compress(authorized_xml.encode())
+                )
+            self.write(vals)
         return ok, msj_list
 
+    def _l10n_ec_get_checkpoint_xml(self):
+        """
+        Devuelve el xml firmado en un intento anterior,
+        si el adjunto no fue modificado desde que se firmo
+        para continuar el envio sin volver a generarlo ni firmarlo
+        :return: bytes con el xml firmado o False
+        """
+        self.ensure_one()
+        if self.l10n_ec_edi_stage not in ("signed", "received"):
+            return False
+        return self._l10n_ec_get_signed_attachment_xml()
+
+    def _l10n_ec_get_reusable_xml(self, render_hash):
+        """
+        Devuelve el xml firmado del adjunto
+        si fue generado con los mismos datos del documento
+        :param render_hash: hash de los datos actuales, ver _l10n_ec_get_render_hash
+        :return: bytes con el xml firmado o False
+        """
+        self.ensure_one()
+        if not render_hash or render_hash != self.l10n_ec_render_hash:
+            return False
+        return self._l10n_ec_get_signed_attachment_xml()
+
+    def _l10n_ec_get_signed_attachment_xml(self):
+        xml_signed = self.attachment_id.raw
+        if (
+            not xml_signed
+            or hashlib.sha256(xml_signed).hexdigest() != self.l10n_ec_signed_xml_hash
+        ):
+            return False
+        return xml_signed
+
+    def _l10n_ec_is_authorized_locally(self):
+        """
+        Indica si el documento ya fue autorizado y su xml autorizado esta guardado,
+        no es necesario consultarlo nuevamente al SRI
+        """
+        self.ensure_one()
+        return self.l10n_ec_edi_stage == "authorized" and bool(
+            self.with_context(bin_size=True).l10n_ec_authorized_xml
+        )
+
+    def _l10n_ec_get_ride_authorization_data(self):
+        """
+        Datos de la autorizacion para imprimir el RIDE,
+        tomados del xml autorizado guardado, sin consultar al SRI
+        :return: dict con numero de autorizacion y clave de acceso
+        """
+        self.ensure_one()
+        access_key = self.l10n_ec_xml_access_key
+        authorized_xml = self._l10n_ec_get_authorized_xml()
+        if authorized_xml:
+            parser = etree.XMLParser(resolve_entities=False, no_network=True)
+            try:
+                access_key = (
+                    etree.fromstring(authorized_xml, parser).findtext(
+                        "infoTributaria/claveAcceso"
+                    )
+                    or access_key
+                )
+            except etree.XMLSyntaxError:
+                _logger.warning(
+                    "Authorized XML of %s can't be read", self.l10n_ec_xml_access_key
+                )
+        return {
+            "authorization_number": self.l10n_ec_authorization_number or access_key,
+            "access_key": access_key,
+        }
+
+    def _l10n_ec_get_authorized_xml(self):
+        """
+        Devuelve el xml autorizado por el SRI guardado en el documento
+        :return: bytes con el xml o False si no fue guardado
+        """
+        self.ensure_one()
+        authorized_xml = self.with_context(bin_size=False).l10n_ec_authorized_xml
+        if not authorized_xml:
+            return False
+        return gzip.decompress(base64.b64decode(authorized_xml))
+
+    @api.model
+    def _l10n_ec_refresh_authorization_status(self, domain=None, auto_commit=False):
+        """
+        Consulta en el SRI la autorizacion de los documentos del dominio,
+        por bloques de l10n_ec_sri_refresh_chunk_size documentos,
+        con hasta l10n_ec_sri_concurrent_requests consultas a la vez.
+        Los resultados se guardan al terminar cada bloque
+        y se libera la cache, para procesar muchos documentos sin cargarlos todos
+        :param domain: dominio de account.edi.document a consultar
+        :param auto_commit: hacer commit luego de cada bloque
+        :return: dict con el numero de documentos consultados y autorizados
+        """
+        edi_format = self.env["account.edi.format"]
+        chunk_size = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("l10n_ec_sri_refresh_chunk_size", 500)
+        )
+        domain = expression.AND(
+            [
+                domain or [],
+                [
+                    ("l10n_ec_xml_access_key", "!=", False),
+                    ("edi_format_id.code", "=", "l10n_ec_format_sri"),
+                ],
+            ]
+        )
+        res = {"checked": 0, "authorized": 0}
+        company_ws = {}
+        last_id = 0
+        while True:
+            edi_docs = self.search(
+                expression.AND([domain, [("id", ">", last_id)]]),
+                order="id",
+                limit=chunk_size,
+            )
+            if not edi_docs:
+                break
+            last_id = edi_docs[-1].id
+            to_check = []
+            jobs = []
+            # autorizados pendientes de procesar por account_edi
+            to_post = self.browse()
+            for edi_doc in edi_docs:
+                if edi_doc._l10n_ec_is_authorized_locally():
+                    # ya autorizado, el xml autorizado esta guardado
+                    res["checked"] += 1
+                    res["authorized"] += 1
+                    if edi_doc.state == "to_send" and edi_doc.attachment_id:
+                        to_post |= edi_doc
+                    continue
+                company = edi_doc.move_id.company_id
+                if company not in company_ws:
+                    company_ws[company] = (
+                        edi_format._l10n_ec_get_edi_ws_client(
+                            company.l10n_ec_type_environment, "authorization"
+                        ),
+                        edi_format._l10n_ec_get_rate_limiter(
+                            company.vat, "authorization"
+                        ),
+                    )
+                auth_client, auth_limiter = company_ws[company]
+                if auth_client is None:
+                    continue
+                to_check.append(edi_doc)
+                jobs.append((auth_client, edi_doc.l10n_ec_xml_access_key, auth_limiter))
+            responses = edi_format._l10n_ec_edi_run_concurrently(
+                edi_send_xml_auth, jobs
+            )
+            circuit_open = False
+            for edi_doc, response in zip(to_check, responses):
+                if isinstance(response, Exception):
+                    circuit_open = circuit_open or isinstance(
+                        response, CircuitOpenError
+                    )
+                    continue
+                res["checked"] += 1
+                ok, msj = edi_doc._l10n_ec_edi_process_response_auth(response)
+                if not ok:
+                    if msj:
+                        # NO AUTORIZADO es una respuesta final, se debe generar
+                        # y enviar nuevamente, no volver a consultarlo
+                        edi_doc.write({"l10n_ec_edi_stage": False})
+                    continue
+                res["authorized"] += 1
+                if edi_doc.state == "to_send" and edi_doc.attachment_id:
+                    to_post |= edi_doc
+            if to_post:
+                # el estado lo cambia account_edi con el resultado de
+                # _post_invoice_edi, que no consulta al SRI los documentos
+                # con el xml autorizado guardado
+                to_post._process_documents_web_services(with_commit=False)
+            self.flush()
+            if auto_commit:
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+            # liberar los registros del bloque
+            self.invalidate_cache()
+            if circuit_open:
+                _logger.warning(
+                    "SRI authorization web service is not available, "
+                    "authorization status refresh stopped"
+                )
+                break
+        _logger.info(
+            "Authorization status refreshed, %s documents checked, %s authorized",
+            res["checked"],
+            res["authorized"],
+        )
+        return res
+
+    def _l10n_ec_action_refresh_authorization_status(self):
+        res = self._l10n_ec_refresh_authorization_status([("id", "in", self.ids)])
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Authorization status refreshed"),
+                "message": _(
+                    "%(checked)s documents checked in SRI, %(authorized)s authorized",
+                    **res,
+                ),
+                "sticky": False,
+            },
+        }
+
+    @api.model
+    def _l10n_ec_action_xml_storage_report(self):
+        res = self.env["ir.attachment"]._l10n_ec_get_xml_storage_report()
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Compressed XML storage"),
+                "message": _(
+                    "%(attachments)s compressed XML, %(original_size)s bytes "
+                    "stored in %(stored_size)s bytes (%(blocks)s shared "
+                    "certificate blocks), %(saved_percent)s%% saved",
+                    **res,
+                ),
+                "sticky": True,
+            },
+        }
+
+    @api.model
+    def _cron_l10n_ec_refresh_authorization_status(self):
+        """
+        Consultar la autorizacion de los documentos recibidos por el SRI
+        sin autorizar, los rechazados o devueltos a borrador ya no se consultan
+        """
+        self._l10n_ec_refresh_authorization_status(
+            [
+                ("l10n_ec_authorization_date", "=", False),
+                ("l10n_ec_last_sent_date", "!=", False),
+                ("l10n_ec_edi_stage", "=", "received"),
+                ("move_id.state", "=", "posted"),
+            ],
+            auto_commit=True,
+        )
+
     def _l10n_ec_get_info_debit_note(self):
         self.ensure_one()
         debit_note = self.move_id
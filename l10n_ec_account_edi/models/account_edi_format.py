@@ -1,26 +1,99 @@
+import hashlib
 import logging
+import os
+import re
+import threading
+import time
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from zeep import Client
 from zeep.transports import Transport
 
 from odoo import _, api, models, tools
+from odoo.exceptions import UserError
+from odoo.modules.module import get_module_resource
 from odoo.tools import float_compare, formatLang
 
+from .account_edi_document import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RateLimiter,
+    edi_send_xml_auth,
+    edi_submit_document,
+)
+from .ir_attachment import COMPRESSED_XML_MODELS
+from .sri_key_type import sign_process_pool_available, xml_tree_to_bytes
+
 _logger = logging.getLogger(__name__)
 
 TEST_URL = {
-    "reception": "https://celcer.sri.gob.ec/comprobantes-electronicos-ws/RecepcionComprobantesOffline?wsdl",  # noqa: B950
-    "authorization": "https://celcer.sri.gob.ec/comprobantes-electronicos-ws/AutorizacionComprobantesOffline?wsdl",  # noqa: B950
+    "reception": "https://celcer.sri.gob.ec/comprobantes-electronicos-ws/RecepcionComprobantesOffline",  # noqa: B950
+    "authorization": "https://celcer.sri.gob.ec/comprobantes-electronicos-ws/AutorizacionComprobantesOffline",  # noqa: B950
 }
 
 PRODUCTION_URL = {
-    "reception": "https://cel.sri.gob.ec/comprobantes-electronicos-ws/RecepcionComprobantesOffline?wsdl",  # noqa: B950
-    "authorization": "https://cel.sri.gob.ec/comprobantes-electronicos-ws/AutorizacionComprobantesOffline?wsdl",  # noqa: B950
+    "reception": "https://cel.sri.gob.ec/comprobantes-electronicos-ws/RecepcionComprobantesOffline",  # noqa: B950
+    "authorization": "https://cel.sri.gob.ec/comprobantes-electronicos-ws/AutorizacionComprobantesOffline",  # noqa: B950
+}
+
+# wsdl incluidos en el modulo y binding a usar con la direccion del servicio
+# asi no es necesario descargarlos del SRI al crear los clientes
+WSDL_FILES = {
+    "reception": (
+        "RecepcionComprobantesOffline.wsdl",
+        "{http://ec.gob.sri.ws.recepcion}RecepcionComprobantesOfflinePortBinding",
+    ),
+    "authorization": (
+        "AutorizacionComprobantesOffline.wsdl",
+        "{http://ec.gob.sri.ws.autorizacion}AutorizacionComprobantesOfflinePortBinding",  # noqa: B950
+    ),
 }
 
 
+class SriClient(Client):
+    """
+    Cliente zeep construido desde el wsdl local,
+    envia las solicitudes a la direccion indicada
+    en lugar de la declarada en el wsdl
+    """
+
+    def __init__(self, wsdl, binding_name, address, circuit_breaker=None, **kwargs):
+        super().__init__(wsdl, **kwargs)
+        self._sri_service = self.create_service(binding_name, address)
+        self.circuit_breaker = circuit_breaker
+
+    @property
+    def service(self):
+        """Servicio enlazado a la direccion indicada, no la del wsdl"""
+        return self._sri_service
+
+
+# clientes de los webservices del SRI, uno por proceso y por url
+# clave: (pid, ambiente, tipo de url, direccion, configuracion del pool http)
+# valor: (zeep.Client, momento de creacion)
+# se reutiliza el wsdl ya parseado y la sesion http, un proceso hijo(fork)
+# o un cambio de la configuracion del pool crea un cliente nuevo
+_ws_clients = {}
+_ws_clients_lock = threading.Lock()
+
+# sesiones http con pool de conexiones, una por proceso y por host
+# clave: (pid, host), valor: (requests.Session, (tamaño del pool, reintentos))
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+# circuit breaker de cada direccion de webservice del SRI, por proceso
+# se mantiene aunque el cliente se cree nuevamente
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
 class AccountEdiFormat(models.Model):
     _inherit = "account.edi.format"
 
@@ -198,109 +271,661 @@ class AccountEdiFormat(models.Model):
         res = {}
         if self.code not in ("l10n_ec_format_sri",):
             return super()._post_invoice_edi(documents)
-        # tomar la primer company, todos los documentos deben pertenecer a la misma company
-        company = documents[0].company_id or self.env.company
-        client_send = self._l10n_ec_get_edi_ws_client(
-            company.l10n_ec_type_environment, "reception"
-        )
-        auth_client = self._l10n_ec_get_edi_ws_client(
-            company.l10n_ec_type_environment, "authorization"
-        )
+        # agrupar por company, cada grupo usa el ambiente y la firma de su company
+        # y comparte los clientes del webservice con los grupos del mismo ambiente
+        documents_by_company = {}
         for document in documents:
-            edi_docs = document.edi_document_ids.filtered(
-                lambda x: x.edi_format_id.code in ("l10n_ec_format_sri",)
-            )
-            if edi_docs:
-                document.write({"l10n_ec_is_edi_doc": True})
-            errors = []
-            try:
-                for edi_doc in edi_docs:
-                    attachment = edi_doc.attachment_id
-                    xml_file = edi_doc._l10n_ec_render_xml_edi()
-                    edi_doc._l10n_ec_action_check_xsd(xml_file)
-                    xml_signed = company.l10n_ec_key_type_id.action_sign(xml_file)
-                    _logger.debug(xml_signed)
-                    if not attachment:
-                        attachment = self.env["ir.attachment"].create(
-                            {
-                                "name": f"{edi_doc._l10n_ec_get_edi_name()}.xml",
-                                "raw": xml_signed.encode(),
-                                "res_model": document._name,
-                                "res_id": document.id,
-                                "mimetype": "application/xml",
-                            }
-                        )
-                    else:
-                        attachment.write(
-                            {
-                                "name": f"{edi_doc._l10n_ec_get_edi_name()}.xml",
-                                "raw": xml_signed.encode(),
-                                "res_model": document._name,
-                                "res_id": document.id,
-                                "mimetype": "application/xml",
-                            }
+            company = document.company_id or self.env.company
+            documents_by_company.setdefault(company, documents.browse())
+            documents_by_company[company] |= document
+        clients = {}
+        document_errors = {}
+        document_attachments = {}
+        # documentos no enviados por no estar disponible el SRI,
+        # se reintentaran en la siguiente ejecucion
+        retry_documents = set()
+        submissions = []
+
+        def ready_documents():
+            # cada documento se envia al SRI apenas esta firmado,
+            # mientras se preparan los siguientes, de esta y de las demas company
+            for company, company_documents in documents_by_company.items():
+                environment = company.l10n_ec_type_environment
+                for (
+                    document,
+                    edi_doc,
+                    xml_signed,
+                ) in self._l10n_ec_edi_prepare_documents(
+                    company_documents, company, document_errors, document_attachments
+                ):
+                    # los clientes se crean solo si hay documentos por enviar
+                    if environment not in clients:
+                        clients[environment] = (
+                            self._l10n_ec_get_edi_ws_client(environment, "reception"),
+                            self._l10n_ec_get_edi_ws_client(
+                                environment, "authorization"
+                            ),
                         )
+                    client_send, auth_client = clients[environment]
                     if client_send is None or auth_client is None:
-                        res.update(
-                            {
-                                document: {
-                                    "success": False,
-                                    "error": _(
-                                        "Can't connect to SRI Webservice, try in few minutes"
-                                    ),
-                                    "attachment": attachment,
-                                    "blocking_level": "error",
-                                }
-                            }
+                        document_errors[document].append(
+                            _("Can't connect to SRI Webservice, try in few minutes")
                         )
                         continue
-                    # intentar consultar el documento previamente autorizado
-                    is_auth = False
-                    ok = False
-                    msj = []
-                    if edi_doc.l10n_ec_last_sent_date:
-                        sri_res = edi_doc._l10n_ec_edi_send_xml_auth(auth_client)
-                        is_auth, msj = edi_doc._l10n_ec_edi_process_response_auth(
-                            sri_res
-                        )
-                        errors.extend(msj)
-                    if not is_auth:
-                        sri_res = edi_doc._l10n_ec_edi_send_xml(client_send, xml_signed)
-                        ok, msj = edi_doc._l10n_ec_edi_process_response_send(sri_res)
-                        errors.extend(msj)
-                    if not is_auth and ok and not msj:
-                        # guardar la fecha de envio al SRI
-                        # en caso de errores, poder saber si hubo un intento o no
-                        # para antes de volver a enviarlo, consultar si se autorizo
-                        edi_doc.write({"l10n_ec_last_sent_date": datetime.now()})
-                        sri_res = edi_doc._l10n_ec_edi_send_xml_auth(auth_client)
-                        ok, msj = edi_doc._l10n_ec_edi_process_response_auth(sri_res)
-                        errors.extend(msj)
-            except Exception as ex:
-                _logger.error(tools.ustr(traceback.format_exc()))
-                errors.append(
+                    submissions.append((document, edi_doc))
+                    yield edi_doc, xml_signed, client_send, auth_client
+
+        results = self._l10n_ec_edi_submit_documents(None, None, ready_documents())
+        # las respuestas se procesan en el hilo principal,
+        # es el unico que escribe en la base de datos
+        for (document, edi_doc), result in zip(submissions, results):
+            if isinstance(result, CircuitOpenError):
+                retry_documents.add(document)
+                document_errors[document].append(
                     _(
-                        "EDI Error creating xml file: %s",
-                        tools.ustr(ex),
+                        "SRI Webservice is not available, "
+                        "the document will be sent again later"
                     )
                 )
+                continue
+            errors, retry = self._l10n_ec_edi_process_submission(edi_doc, result)
+            document_errors[document].extend(errors)
+            if retry:
+                retry_documents.add(document)
+        for document, errors in document_errors.items():
             blocking_level = False
             if errors:
                 blocking_level = "error"
+                if document in retry_documents:
+                    blocking_level = "warning"
             res.update(
                 {
                     document: {
                         "success": not errors and True or False,
                         "error": "".join(errors),
-                        "attachment": attachment,
+                        "attachment": document_attachments[document],
                         "blocking_level": blocking_level,
                     }
                 }
             )
         return res
 
+    def _l10n_ec_edi_prepare_documents(
+        self, documents, company, document_errors, document_attachments
+    ):
+        """
+        Genera, valida y firma el xml de los documentos y guarda el adjunto
+        Con el parametro l10n_ec_edi_cpu_workers mayor a 1, la validacion xsd
+        y la firma se hacen en un pool de procesos mientras se generan
+        los siguientes documentos, la generacion usa el ORM
+        y se queda en el proceso principal
+        Los adjuntos se guardan por bloques de l10n_ec_edi_attachment_batch_size
+        documentos, cada bloque se entrega luego de guardarlo,
+        asi no se envia al SRI un xml que no quedo guardado
+        :param document_errors: dict {documento: lista de errores}, se llena aqui
+        :param document_attachments: dict {documento: adjunto}, se llena aqui
+        :return: generador de tuplas(documento, account.edi.document, xml firmado)
+            entregadas apenas cada documento esta firmado y guardado
+        """
+        edi_docs_by_document = []
+        for document in documents:
+            edi_docs = document.edi_document_ids.filtered(
+                lambda x: x.edi_format_id.code in ("l10n_ec_format_sri",)
+            )
+            if edi_docs:
+                document.write({"l10n_ec_is_edi_doc": True})
+            document_errors[document] = []
+            document_attachments[document] = False
+            # ya autorizados en un intento anterior, con el xml autorizado guardado
+            # no se firman ni se envian nuevamente al SRI
+            authorized = edi_docs.filtered(lambda x: x._l10n_ec_is_authorized_locally())
+            if authorized:
+                document_attachments[document] = authorized[-1].attachment_id
+                edi_docs -= authorized
+            edi_docs_by_document.append((document, edi_docs))
+        ICP = self.env["ir.config_parameter"].sudo()
+        cpu_workers = int(ICP.get_param("l10n_ec_edi_cpu_workers", 1))
+        batch_size = int(ICP.get_param("l10n_ec_edi_attachment_batch_size", 100))
+        total_edi_docs = sum(len(edi_docs) for _doc, edi_docs in edi_docs_by_document)
+        # con pocos documentos no vale la pena crear los procesos
+        # con el servicio de firma compartido, la firma ya se hace en paralelo alla
+        # en modo multihilo no se puede hacer fork de forma segura
+        if (
+            cpu_workers <= 1
+            or total_edi_docs < cpu_workers * 2
+            or tools.config.get("l10n_ec_signing_service_socket")
+            or not sign_process_pool_available()
+        ):
+            prepared = self._l10n_ec_edi_prepare_documents_serial(
+                edi_docs_by_document, company, document_errors, document_attachments
+            )
+        else:
+            prepared = self._l10n_ec_edi_prepare_documents_parallel(
+                edi_docs_by_document,
+                company,
+                document_errors,
+                document_attachments,
+                cpu_workers,
+            )
+        # los adjuntos se guardan juntos, sin esperar a cada documento,
+        # mientras se envia un bloque se firma el siguiente
+        to_save = []
+        for document, edi_doc, xml_signed, render_hash in prepared:
+            if render_hash is None:
+                # xml del adjunto ya guardado en un intento anterior
+                yield document, edi_doc, xml_signed
+                continue
+            to_save.append((document, edi_doc, xml_signed, render_hash))
+            if len(to_save) >= batch_size:
+                yield from self._l10n_ec_edi_flush_attachments(
+                    to_save, document_errors, document_attachments
+                )
+                to_save = []
+        if to_save:
+            yield from self._l10n_ec_edi_flush_attachments(
+                to_save, document_errors, document_attachments
+            )
+
+    def _l10n_ec_edi_flush_attachments(
+        self, signed_documents, document_errors, document_attachments
+    ):
+        """
+        Guarda los adjuntos de un bloque de documentos firmados
+        :return: lista de tuplas(documento, account.edi.document, xml firmado)
+            de los documentos guardados, vacia si no se pudo guardar el bloque
+        """
+        try:
+            with self.env.cr.savepoint():
+                attachments = self._l10n_ec_edi_save_attachments(signed_documents)
+        except Exception as ex:
+            for document, _edi_doc, _xml_signed, _render_hash in signed_documents:
+                self._l10n_ec_edi_add_error(document_errors[document], ex)
+            return []
+        saved = []
+        for document, edi_doc, xml_signed, _render_hash in signed_documents:
+            document_attachments[document] = attachments[edi_doc]
+            saved.append((document, edi_doc, xml_signed))
+        return saved
+
+    def _l10n_ec_edi_prepare_documents_serial(
+        self, edi_docs_by_document, company, document_errors, document_attachments
+    ):
+        for document, edi_docs in edi_docs_by_document:
+            ready = []
+            try:
+                for edi_doc in edi_docs:
+                    document_attachments[document] = edi_doc.attachment_id
+                    (
+                        xml_signed,
+                        render_data,
+                        render_hash,
+                    ) = self._l10n_ec_edi_get_reusable(edi_doc)
+                    if xml_signed:
+                        ready.append((document, edi_doc, xml_signed, None))
+                        continue
+                    # un solo arbol xml para validar y firmar,
+                    # serializado una sola vez para el adjunto y el webservice
+                    xml_tree = edi_doc._l10n_ec_render_xml_edi_tree(render_data)
+                    edi_doc._l10n_ec_action_check_xsd(xml_tree)
+                    company.l10n_ec_key_type_id.action_sign_tree(xml_tree)
+                    xml_signed = xml_tree_to_bytes(xml_tree)
+                    ready.append((document, edi_doc, xml_signed, render_hash))
+            except Exception as ex:
+                self._l10n_ec_edi_add_error(document_errors[document], ex)
+            yield from ready
+
+    def _l10n_ec_edi_prepare_documents_parallel(
+        self,
+        edi_docs_by_document,
+        company,
+        document_errors,
+        document_attachments,
+        cpu_workers,
+    ):
+        key_type = company.l10n_ec_key_type_id
+        raise_xsd_error = self.env["account.edi.document"]._l10n_ec_raise_xsd_error()
+        # compilar los esquemas antes de crear los procesos, asi los heredan
+        xsd_schemas = self._l10n_ec_edi_load_xsd_schemas(edi_docs_by_document)
+        pending = deque()
+        try:
+            executor = key_type._get_sign_process_pool(cpu_workers, xsd_schemas)
+        except Exception as ex:
+            # certificado invalido o sin recursos para crear los procesos,
+            # no se puede firmar ningun documento de la company
+            _logger.warning(
+                "Can't create signing process pool for company %s: %s",
+                company.name,
+                tools.ustr(ex),
+            )
+            for document, edi_docs in edi_docs_by_document:
+                if edi_docs:
+                    self._l10n_ec_edi_add_error(document_errors[document], ex)
+            return
+        with executor:
+            for document, edi_docs in edi_docs_by_document:
+                resumed = []
+                try:
+                    for edi_doc in edi_docs:
+                        document_attachments[document] = edi_doc.attachment_id
+                        (
+                            xml_signed,
+                            render_data,
+                            render_hash,
+                        ) = self._l10n_ec_edi_get_reusable(edi_doc)
+                        if xml_signed:
+                            resumed.append((document, edi_doc, xml_signed, None))
+                            continue
+                        xsd_key = edi_doc._l10n_ec_get_xsd_key()
+                        if xsd_schemas.get(xsd_key) is None:
+                            raise UserError(
+                                _("XSD schema not found for %s version %s") % xsd_key
+                            )
+                        future = key_type._submit_check_and_sign(
+                            executor,
+                            str(edi_doc._l10n_ec_render_xml_edi(render_data)),
+                            xsd_key,
+                            raise_xsd_error,
+                        )
+                        pending.append((document, edi_doc, future, render_hash))
+                except Exception as ex:
+                    self._l10n_ec_edi_add_error(document_errors[document], ex)
+                yield from resumed
+                # entregar los documentos ya firmados sin esperar a los demas
+                while pending and pending[0][2].done():
+                    ready = self._l10n_ec_edi_finish_signing(
+                        *pending.popleft(), document_errors
+                    )
+                    if ready:
+                        yield ready
+            while pending:
+                ready = self._l10n_ec_edi_finish_signing(
+                    *pending.popleft(), document_errors
+                )
+                if ready:
+                    yield ready
+
     @api.model
-    def _l10n_ec_get_edi_ws_client(self, environment, url_type):
+    def _l10n_ec_edi_get_reusable(self, edi_doc):
+        """
+        Busca un xml firmado que se pueda reutilizar sin generarlo ni firmarlo:
+        el del intento anterior, o el del adjunto si los datos del documento
+        no cambiaron desde que se genero
+        :return: tuple(xml firmado o False, tuple(plantilla, datos) para generarlo,
+            hash de los datos)
+        """
+        xml_signed = edi_doc._l10n_ec_get_checkpoint_xml()
+        if xml_signed:
+            return xml_signed, None, False
+        render_data = edi_doc._l10n_ec_get_xml_edi_render_data()
+        render_hash = edi_doc._l10n_ec_get_render_hash(render_data)
+        xml_signed = edi_doc._l10n_ec_get_reusable_xml(render_hash)
+        if xml_signed:
+            _logger.debug(
+                "Reusing signed XML of %s, data not changed",
+                edi_doc.l10n_ec_xml_access_key,
+            )
+            edi_doc.write({"l10n_ec_edi_stage": "signed"})
+        return xml_signed, render_data, render_hash
+
+    @api.model
+    def _l10n_ec_edi_load_xsd_schemas(self, edi_docs_by_document):
+        """
+        Carga los esquemas xsd de los documentos que se deben firmar
+        :return: dict {clave del esquema: XMLSchema o None si no se pudo cargar}
+        """
+        xsd_schemas = {}
+        for _document, edi_docs in edi_docs_by_document:
+            for edi_doc in edi_docs:
+                if edi_doc.l10n_ec_edi_stage in ("signed", "received"):
+                    continue
+                xsd_key = edi_doc._l10n_ec_get_xsd_key()
+                if xsd_key in xsd_schemas:
+                    continue
+                try:
+                    xsd_schemas[xsd_key] = edi_doc._l10n_ec_get_xsd_schema_from_key(
+                        *xsd_key
+                    )[0]
+                except Exception as ex:
+                    _logger.warning(
+                        "Can't load XSD schema %s: %s", xsd_key, tools.ustr(ex)
+                    )
+                    xsd_schemas[xsd_key] = None
+        return xsd_schemas
+
+    def _l10n_ec_edi_finish_signing(
+        self, document, edi_doc, future, render_hash, document_errors
+    ):
+        """
+        Toma el resultado de la firma hecha en el pool de procesos
+        :return: tuple(documento, account.edi.document, xml firmado, hash de los datos)
+            o False si hubo error
+        """
+        try:
+            xml_signed, error = future.result()
+            if error:
+                error_type, message = error
+                if error_type == "xsd":
+                    raise UserError(_("Wrong XML File, Detail: \n%s") % message)
+                raise UserError(message)
+        except Exception as ex:
+            self._l10n_ec_edi_add_error(document_errors[document], ex)
+            return False
+        return document, edi_doc, xml_signed, render_hash
+
+    def _l10n_ec_edi_save_attachment(
+        self, document, edi_doc, xml_signed, render_hash=False
+    ):
+        """
+        Crea o actualiza el adjunto con el xml firmado
+        y marca el documento como firmado, un nuevo intento
+        continuara desde este xml sin generarlo ni firmarlo otra vez
+        :param render_hash: hash de los datos con los que se genero el xml
+        :return: ir.attachment
+        """
+        return self._l10n_ec_edi_save_attachments(
+            [(document, edi_doc, xml_signed, render_hash)]
+        )[edi_doc]
+
+    def _l10n_ec_edi_save_attachments(self, signed_documents):
+        """
+        Guarda los xml firmados de varios documentos,
+        los adjuntos nuevos se crean en una sola llamada
+        :param signed_documents: lista de tuplas(documento, account.edi.document,
+            xml firmado, hash de los datos con los que se genero el xml)
+        :return: dict {account.edi.document: ir.attachment}
+        """
+        attachments = {}
+        to_create = []
+        contents = [
+            xml_signed for _doc, _edi_doc, xml_signed, _hash in signed_documents
+        ]
+        compressed = [False] * len(contents)
+        # con l10n_ec_edi_compress_xml se guardan comprimidos,
+        # el adjunto se descomprime al leerlo
+        if tools.str2bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("l10n_ec_edi_compress_xml", "False")
+        ):
+            # los bloques compartidos se guardan en la company de cada documento
+            indexes_by_company = {}
+            for index, (document, _edi_doc, _xml_signed, _hash) in enumerate(
+                signed_documents
+            ):
+                if document._name in COMPRESSED_XML_MODELS:
+                    indexes_by_company.setdefault(document.company_id, []).append(index)
+            for company, indexes in indexes_by_company.items():
+                company_contents = self.env["ir.attachment"]._l10n_ec_compress_xml(
+                    [contents[index] for index in indexes], company
+                )
+                for index, content in zip(indexes, company_contents):
+                    contents[index] = content
+                    compressed[index] = True
+        for (
+            (document, edi_doc, xml_signed, _render_hash),
+            content,
+            is_compressed,
+        ) in zip(signed_documents, contents, compressed):
+            _logger.debug(xml_signed)
+            vals = {
+                "name": f"{edi_doc._l10n_ec_get_edi_name()}.xml",
+                "raw": content,
+                "res_model": document._name,
+                "res_id": document.id,
+                "mimetype": "application/xml",
+                "l10n_ec_compressed_xml": is_compressed,
+            }
+            if edi_doc.attachment_id:
+                edi_doc.attachment_id.write(vals)
+                attachments[edi_doc] = edi_doc.attachment_id
+            else:
+                to_create.append((edi_doc, vals))
+        if to_create:
+            new_attachments = self.env["ir.attachment"].create(
+                [vals for _edi_doc, vals in to_create]
+            )
+            for (edi_doc, _vals), attachment in zip(to_create, new_attachments):
+                attachments[edi_doc] = attachment
+        for _document, edi_doc, xml_signed, render_hash in signed_documents:
+            edi_doc.write(
+                {
+                    "attachment_id": attachments[edi_doc].id,
+                    "l10n_ec_edi_stage": "signed",
+                    "l10n_ec_signed_xml_hash": hashlib.sha256(xml_signed).hexdigest(),
+                    "l10n_ec_render_hash": render_hash,
+                }
+            )
+        return attachments
+
+    @api.model
+    def _l10n_ec_edi_add_error(self, errors, ex):
+        _logger.error(tools.ustr(traceback.format_exc()))
+        errors.append(
+            _(
+                "EDI Error creating xml file: %s",
+                tools.ustr(ex),
+            )
+        )
+
+    @api.model
+    def _l10n_ec_edi_submit_documents(self, client_send, auth_client, edi_docs):
+        """
+        Envia los documentos al SRI y solicita su autorizacion,
+        manteniendo hasta l10n_ec_sri_concurrent_requests solicitudes a la vez
+        Con el parametro l10n_ec_sri_two_phase_submission se envian primero
+        todos los documentos, y luego de l10n_ec_sri_authorization_delay segundos
+        se consulta la autorizacion de todos los recibidos en una sola pasada,
+        dando tiempo al SRI de procesarlos mientras se envian los demas
+        :param edi_docs: lista o generador de tuplas(account.edi.document, xml firmado)
+            cada documento se envia apenas el generador lo entrega
+            la tupla puede incluir los clientes de recepcion y autorizacion
+            del documento, para enviar documentos de varios ambientes a la vez,
+            caso contrario se usan client_send y auth_client
+        :return: lista con el resultado de cada documento, en el mismo orden,
+            dict de edi_submit_document o la excepcion producida al enviarlo
+        """
+        ICP = self.env["ir.config_parameter"].sudo()
+        two_phase = tools.str2bool(
+            ICP.get_param("l10n_ec_sri_two_phase_submission", "False")
+        )
+        submitted = []
+        company_limiters = {}
+
+        def iter_jobs():
+            # leer los datos antes de enviar, los hilos no deben usar el ORM
+            for edi_doc, xml_signed, *doc_clients in edi_docs:
+                doc_client_send, doc_auth_client = doc_clients or (
+                    client_send,
+                    auth_client,
+                )
+                vat = edi_doc.move_id.company_id.vat
+                if vat not in company_limiters:
+                    company_limiters[vat] = (
+                        self._l10n_ec_get_rate_limiter(vat, "reception"),
+                        self._l10n_ec_get_rate_limiter(vat, "authorization"),
+                    )
+                send_limiter, auth_limiter = company_limiters[vat]
+                submitted.append((edi_doc, doc_auth_client, auth_limiter))
+                yield (
+                    doc_client_send,
+                    doc_auth_client,
+                    edi_doc.l10n_ec_xml_access_key,
+                    xml_signed,
+                    bool(edi_doc.l10n_ec_last_sent_date),
+                    not two_phase,
+                    send_limiter,
+                    auth_limiter,
+                    edi_doc.l10n_ec_edi_stage == "received",
+                )
+
+        results = self._l10n_ec_edi_run_concurrently(edi_submit_document, iter_jobs())
+        if not two_phase:
+            return results
+        received = [
+            result
+            for result in results
+            if isinstance(result, dict) and result["sent_date"]
+        ]
+        if not received:
+            return results
+        delay = float(ICP.get_param("l10n_ec_sri_authorization_delay", 3))
+        last_sent_date = max(result["sent_date"] for result in received)
+        remaining = delay - (datetime.now() - last_sent_date).total_seconds()
+        if remaining > 0:
+            time.sleep(remaining)
+        auth_jobs = [
+            (doc_auth_client, edi_doc.l10n_ec_xml_access_key, auth_limiter)
+            for (edi_doc, doc_auth_client, auth_limiter), result in zip(
+                submitted, results
+            )
+            if isinstance(result, dict) and result["sent_date"]
+        ]
+        auth_responses = self._l10n_ec_edi_run_concurrently(
+            edi_send_xml_auth, auth_jobs
+        )
+        for result, auth_response in zip(received, auth_responses):
+            # sin respuesta de autorizacion se consultara en el siguiente envio
+            if not isinstance(auth_response, Exception):
+                result["auth"] = auth_response
+        return results
+
+    @api.model
+    def _l10n_ec_edi_run_concurrently(self, function, jobs):
+        """
+        Ejecuta la funcion con los argumentos de cada trabajo,
+        hasta l10n_ec_sri_concurrent_requests a la vez
+        :param jobs: lista o generador de tuplas con los argumentos,
+            los trabajos de un generador se inician apenas son entregados
+        :return: lista con el resultado de cada trabajo, en el mismo orden,
+            o la excepcion producida
+        """
+        max_workers = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("l10n_ec_sri_concurrent_requests", 1)
+        )
+        if isinstance(jobs, list):
+            max_workers = min(max_workers, len(jobs))
+        results = []
+        if max_workers <= 1:
+            for job in jobs:
+                try:
+                    results.append(function(*job))
+                except Exception as ex:
+                    results.append(ex)
+            return results
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(function, *job) for job in jobs]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as ex:
+                    results.append(ex)
+        return results
+
+    @api.model
+    def _l10n_ec_edi_process_submission(self, edi_doc, result):
+        """
+        Procesa las respuestas del SRI obtenidas al enviar el documento
+        y guarda los resultados en el account.edi.document
+        :return: tuple(lista de errores, reintentar)
+            reintentar es True cuando no hubo respuesta del SRI o el documento
+            fue recibido pero aun no autorizado, se volvera a intentar
+            sin bloquear el documento
+        """
+        errors = []
+        retry = False
+        try:
+            if isinstance(result, Exception):
+                raise result
+            # intentar consultar el documento previamente autorizado
+            is_auth = False
+            ok = False
+            msj = []
+            if edi_doc.l10n_ec_last_sent_date:
+                is_auth, msj = edi_doc._l10n_ec_edi_process_response_auth(
+                    result["auth_before"]
+                )
+                errors.extend(msj)
+            if not is_auth and result["send_skipped"]:
+                # recibido en un intento anterior, aun sin autorizar,
+                # si fue rechazado se debe generar y firmar nuevamente
+                if msj:
+                    edi_doc.write({"l10n_ec_edi_stage": False})
+                    return errors, retry
+                # EN PROCESO o sin respuesta del SRI, consultar nuevamente
+                errors.append(
+                    _("The document was received by SRI and is pending authorization")
+                )
+                return errors, True
+            if not is_auth and not result["send"]:
+                # sin respuesta de la recepcion, se enviara nuevamente
+                errors.append(_("Can't connect to SRI Webservice, try in few minutes"))
+                return errors, True
+            if not is_auth:
+                ok, msj = edi_doc._l10n_ec_edi_process_response_send(result["send"])
+                errors.extend(msj)
+                if msj:
+                    # devuelto por el SRI, el siguiente intento
+                    # debe generar y firmar nuevamente el xml
+                    edi_doc.write({"l10n_ec_edi_stage": False})
+            if not is_auth and ok and not msj:
+                # guardar la fecha de envio al SRI
+                # en caso de errores, poder saber si hubo un intento o no
+                # para antes de volver a enviarlo, consultar si se autorizo
+                edi_doc.write(
+                    {
+                        "l10n_ec_last_sent_date": result["sent_date"],
+                        "l10n_ec_edi_stage": "received",
+                    }
+                )
+                is_auth, msj = edi_doc._l10n_ec_edi_process_response_auth(
+                    result["auth"]
+                )
+                errors.extend(msj)
+                if not is_auth and msj:
+                    # NO AUTORIZADO, generar y firmar nuevamente
+                    edi_doc.write({"l10n_ec_edi_stage": False})
+                if not is_auth and not msj:
+                    # el SRI aun lo esta procesando(EN PROCESO) o no respondio
+                    # la autorizacion se consultara en el siguiente intento
+                    errors.append(
+                        _(
+                            "The document was received by SRI "
+                            "and is pending authorization"
+                        )
+                    )
+                    retry = True
+        except Exception as ex:
+            _logger.error(tools.ustr(ex))
+            errors.append(
+                _(
+                    "EDI Error sending the document to SRI: %s",
+                    tools.ustr(ex),
+                )
+            )
+        return errors, retry
+
+    @api.model
+    def _l10n_ec_get_rate_limiter(self, vat, url_type):
+        """
+        Limitador de solicitudes al webservice del SRI para el RUC,
+        compartido por todos los workers del servidor,
+        permite l10n_ec_sri_rate_limit solicitudes por segundo
+        (0 sin limite) y hasta l10n_ec_sri_rate_burst seguidas
+        """
+        ICP = self.env["ir.config_parameter"].sudo()
+        rate = float(ICP.get_param("l10n_ec_sri_rate_limit", 0))
+        if rate <= 0 or not vat:
+            return None
+        burst = int(ICP.get_param("l10n_ec_sri_rate_burst", 1))
+        limits_path = os.path.join(tools.config["data_dir"], "l10n_ec_sri_rate_limit")
+        os.makedirs(limits_path, exist_ok=True)
+        filename = "%s_%s" % (re.sub(r"\W", "", vat), url_type)
+        return RateLimiter(os.path.join(limits_path, filename), rate, burst)
+
+    @api.model
+    def _l10n_ec_get_edi_ws_client(self, environment, url_type, force_refresh=False):
         """
         :param environment: tipo de ambiente, puede ser:
             test: Pruebas
@@ -308,23 +933,199 @@ class AccountEdiFormat(models.Model):
         :param url_type: el tipo de url a solicitar, puede ser:
             reception: url para recepcion de documentos
             authorization: url para autorizacion de documentos
+        :param force_refresh: crear nuevamente el cliente aunque este en cache
         :return:
         """
         # Debido a que el servidor esta rechazando las conexiones contantemente,
         # es necesario que se cree una sola instancia
         # Para conexion y asi evitar un reinicio constante de la comunicacion
+        address = self._l10n_ec_get_edi_ws_address(environment, url_type)
+        key = (
+            os.getpid(),
+            environment,
+            url_type,
+            address,
+            self._l10n_ec_get_http_session_settings(),
+        )
+        ttl = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("l10n_ec_ws_client_ttl", 3600)
+        )
+        with _ws_clients_lock:
+            cached_client, created_at = _ws_clients.get(key, (None, 0))
+        if (
+            cached_client is not None
+            and not force_refresh
+            and time.monotonic() - created_at < ttl
+        ):
+            return cached_client
+        wsClient = self._l10n_ec_create_edi_ws_client(url_type, address)
+        if wsClient is None:
+            if cached_client is not None:
+                # el SRI no responde, seguir usando el wsdl ya cargado
+                _logger.warning(
+                    "Using previous web service client of SRI for %s %s",
+                    environment,
+                    url_type,
+                )
+            return cached_client
+        with _ws_clients_lock:
+            _ws_clients[key] = (wsClient, time.monotonic())
+        return wsClient
+
+    @api.model
+    def _l10n_ec_get_edi_ws_address(self, environment, url_type):
+        """
+        Direccion del webservice del SRI, se puede reemplazar por ambiente
+        con el parametro del sistema l10n_ec_sri_<ambiente>_<tipo de url>_url
+        por ejemplo para usar un servidor local en las pruebas
+        """
+        default_urls = PRODUCTION_URL if environment == "production" else TEST_URL
+        return (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param(
+                f"l10n_ec_sri_{environment}_{url_type}_url",
+                default_urls.get(url_type),
+            )
+        )
+
+    @api.model
+    def _l10n_ec_create_edi_ws_client(self, url_type, address):
         wsClient = None
-        if environment == "test":
-            ws_url = TEST_URL.get(url_type)
-        elif environment == "production":
-            ws_url = PRODUCTION_URL.get(url_type)
+        wsdl_filename, binding_name = WSDL_FILES[url_type]
+        wsdl_path = get_module_resource(
+            "l10n_ec_account_edi", "data", "wsdl", wsdl_filename
+        )
         try:
-            transport = Transport(timeout=30)
-            wsClient = Client(ws_url, transport=transport)
+            transport = Transport(
+                session=self._l10n_ec_get_http_session(address), timeout=30
+            )
+            wsClient = SriClient(
+                wsdl_path,
+                binding_name,
+                address,
+                circuit_breaker=self._l10n_ec_get_circuit_breaker(address),
+                transport=transport,
+            )
         except Exception as e:
             _logger.warning(
                 "Error in Connection with web services of SRI: %s. Error: %s",
-                ws_url,
+                address,
                 tools.ustr(e),
             )
         return wsClient
+
+    @api.model
+    def _l10n_ec_get_http_session(self, address):
+        """
+        Devuelve la sesion http del proceso para el host de la direccion,
+        las conexiones se mantienen abiertas y se reutilizan entre
+        la recepcion y autorizacion de todos los documentos
+        """
+        settings = self._l10n_ec_get_http_session_settings()
+        key = (os.getpid(), urlsplit(address).netloc)
+        with _http_sessions_lock:
+            session, session_settings = _http_sessions.get(key, (None, None))
+            if session is None or session_settings != settings:
+                pool_size, retries = settings
+                # solo reintentar errores de conexion,
+                # un documento enviado no se debe enviar nuevamente
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=pool_size,
+                    max_retries=Retry(
+                        total=retries, read=0, status=0, backoff_factor=0.5
+                    ),
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _http_sessions[key] = (session, settings)
+        return session
+
+    @api.model
+    def _l10n_ec_get_http_session_settings(self):
+        """
+        :return: tuple(tamaño del pool de conexiones, reintentos de conexion)
+        """
+        ICP = self.env["ir.config_parameter"].sudo()
+        return (
+            int(ICP.get_param("l10n_ec_sri_pool_size", 10)),
+            int(ICP.get_param("l10n_ec_sri_pool_retries", 3)),
+        )
+
+    @api.model
+    def _l10n_ec_get_http_session_info(self):
+        """
+        Estadisticas de reutilizacion de conexiones de las sesiones http
+        del proceso actual
+        :return: dict {host: {requests, connections, reused}}
+        """
+        info = {}
+        with _http_sessions_lock:
+            sessions = [
+                (host, session)
+                for (pid, host), (session, _settings) in _http_sessions.items()
+                if pid == os.getpid()
+            ]
+        for host, session in sessions:
+            host_info = info.setdefault(host, {"requests": 0, "connections": 0})
+            adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+            for adapter in adapters.values():
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools.get(key)
+                    if pool is None:
+                        continue
+                    host_info["requests"] += pool.num_requests
+                    host_info["connections"] += pool.num_connections
+        for host_info in info.values():
+            host_info["reused"] = host_info["requests"] - host_info["connections"]
+        return info
+
+    @api.model
+    def _l10n_ec_get_circuit_breaker(self, address):
+        """
+        Devuelve el circuit breaker del proceso para la direccion del webservice
+        se abre luego de l10n_ec_sri_breaker_threshold errores de conexion seguidos
+        y prueba nuevamente luego de l10n_ec_sri_breaker_cool_down segundos
+        """
+        ICP = self.env["ir.config_parameter"].sudo()
+        failure_threshold = int(ICP.get_param("l10n_ec_sri_breaker_threshold", 5))
+        cool_down = float(ICP.get_param("l10n_ec_sri_breaker_cool_down", 60))
+        with _circuit_breakers_lock:
+            breaker = _circuit_breakers.get(address)
+            if breaker is None:
+                breaker = _circuit_breakers[address] = CircuitBreaker(address)
+            breaker.failure_threshold = failure_threshold
+            breaker.cool_down = cool_down
+        return breaker
+
+    @api.model
+    def _l10n_ec_get_circuit_breaker_info(self):
+        """
+        Estado de los circuit breaker del proceso actual
+        :return: dict {direccion: {state, failures}}
+        """
+        with _circuit_breakers_lock:
+            return {
+                address: {"state": breaker.state, "failures": breaker.failures}
+                for address, breaker in _circuit_breakers.items()
+            }
+
+    @api.model
+    def _l10n_ec_refresh_edi_ws_clients(self, environment=None, url_type=None):
+        """
+        Descarta los clientes de webservice en cache del proceso,
+        se crearan nuevamente en la siguiente solicitud
+        :param environment: ambiente a descartar, todos si no se indica
+        :param url_type: tipo de url a descartar, todos si no se indica
+        """
+        with _ws_clients_lock:
+            for key in list(_ws_clients):
+                if environment and key[1] != environment:
+                    continue
+                if url_type and key[2] != url_type:
+                    continue
+                del _ws_clients[key]
@@ -184,6 +184,14 @@ class AccountMove(models.Model):
             return "l10n_ec_account_edi.report_invoice_document"
         return super()._get_name_invoice_report()
 
+    def button_draft(self):
+        # al volver a borrador el documento puede cambiar,
+        # el siguiente envio debe generar y firmar el xml nuevamente
+        self.edi_document_ids.filtered(lambda d: d.l10n_ec_edi_stage == "signed").write(
+            {"l10n_ec_edi_stage": False}
+        )
+        return super().button_draft()
+
     def _l10n_ec_get_document_date(self):
         return self.invoice_date
 
@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import re
+import struct
+import threading
+import zlib
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+# cabecera del xml comprimido: marca + tamaño original en 8 bytes
+COMPRESSED_XML_MAGIC = b"L10NECXZ1\n"
+COMPRESSED_XML_HEADER_SIZE = len(COMPRESSED_XML_MAGIC) + 8
+# contenido del KeyInfo, igual en todos los documentos firmados con el mismo
+# certificado(X509Certificate, Modulus, Exponent), solo el Id del nodo cambia
+KEY_INFO_PATTERN = re.compile(rb"(<ds:KeyInfo\b[^>]*>)(.*?)(</ds:KeyInfo>)", re.S)
+# referencia al bloque guardado una sola vez, \x00 no es valido en xml
+BLOCK_REFERENCE_PATTERN = re.compile(rb"\x00BLOCK:([0-9a-f]{40})\x00")
+BLOCK_PREFIX = "l10n_ec_xml_block_"
+# los bloques mas cortos que la referencia se dejan en el xml
+BLOCK_REFERENCE_SIZE = len(b"\x00BLOCK:\x00") + 40
+# documentos cuyo xml firmado se puede guardar comprimido
+COMPRESSED_XML_MODELS = ("account.move",)
+# los bloques no cambian, su contenido se identifica por el sha1
+_xml_blocks = {}
+_xml_blocks_lock = threading.Lock()
+
+
+class IrAttachment(models.Model):
+    _inherit = "ir.attachment"
+
+    l10n_ec_compressed_xml = fields.Boolean(
+        "Compressed XML(EC)",
+        readonly=True,
+        help="Signed XML stored compressed by Ecuadorian EDI",
+    )
+
+    @api.depends("store_fname", "db_datas", "l10n_ec_compressed_xml")
+    def _compute_raw(self):
+        super()._compute_raw()
+        # descomprimir solo al leer el contenido, por ejemplo al descargarlo
+        # solo los adjuntos guardados comprimidos por este modulo,
+        # la marca se mantiene al copiar el adjunto a otro modelo
+        # no se usa el mimetype, para usuarios sin permisos de admin
+        # los xml se guardan como text/plain
+        for attachment in self:
+            if not attachment.l10n_ec_compressed_xml:
+                continue
+            raw = attachment.raw
+            if raw and raw[: len(COMPRESSED_XML_MAGIC)] == COMPRESSED_XML_MAGIC:
+                attachment.raw = self._l10n_ec_decompress_xml(raw, attachment.name)
+
+    @api.ondelete(at_uninstall=False)
+    def _unlink_except_l10n_ec_xml_blocks(self):
+        """
+        Los bloques compartidos son necesarios para leer los xml comprimidos,
+        no se pueden eliminar mientras existan xml comprimidos
+        """
+        blocks = self.filtered(
+            lambda x: x.res_model == "res.company"
+            and (x.name or "").startswith(BLOCK_PREFIX)
+        )
+        if not blocks:
+            return
+        compressed = self.sudo().search(
+            [("l10n_ec_compressed_xml", "=", True), ("id", "not in", self.ids)],
+            limit=1,
+        )
+        if compressed:
+            raise UserError(
+                _(
+                    "The attachment %s holds a certificate shared by the "
+                    "compressed signed XML files, it can't be deleted"
+                )
+                % blocks[0].name
+            )
+
+    @api.model
+    def _l10n_ec_compress_xml(self, xml_documents, company):
+        """
+        Comprime los xml firmados y guarda una sola vez el contenido del KeyInfo,
+        compartido por todos los documentos del mismo certificado
+        :param xml_documents: lista de bytes con los xml firmados
+        :param company: res.company de los documentos, dueña de los bloques
+        :return: lista de bytes para guardar en el adjunto, en el mismo orden
+        """
+        blocks = {}
+
+        def store_block(match):
+            block = match.group(2)
+            if len(block) <= BLOCK_REFERENCE_SIZE:
+                return match.group(0)
+            checksum = hashlib.sha1(block).hexdigest()
+            blocks[checksum] = block
+            return b"%s\x00BLOCK:%s\x00%s" % (
+                match.group(1),
+                checksum.encode(),
+                match.group(3),
+            )
+
+        res = []
+        for xml_data in xml_documents:
+            content = KEY_INFO_PATTERN.sub(store_block, xml_data)
+            res.append(
+                COMPRESSED_XML_MAGIC
+                + struct.pack(">Q", len(xml_data))
+                + zlib.compress(content)
+            )
+        self._l10n_ec_store_xml_blocks(blocks, company)
+        return res
+
+    @api.model
+    def _l10n_ec_store_xml_blocks(self, blocks, company):
+        """
+        Crea los adjuntos de los bloques que aun no existen,
+        ligados a la company, asi no quedan como adjuntos huerfanos
+        :param blocks: dict {sha1: bytes}
+        :param company: res.company dueña de los bloques
+        """
+        if not blocks:
+            return
+        Attachment = self.sudo()
+        existing = Attachment.search(
+            [
+                ("checksum", "in", list(blocks)),
+                ("name", "=like", f"{BLOCK_PREFIX}%"),
+                ("res_model", "=", company._name),
+                ("res_id", "=", company.id),
+            ]
+        ).mapped("checksum")
+        to_create = [
+            {
+                "name": f"{BLOCK_PREFIX}{checksum}",
+                "raw": block,
+                "mimetype": "application/octet-stream",
+                "res_model": company._name,
+                "res_id": company.id,
+            }
+            for checksum, block in blocks.items()
+            if checksum not in existing
+        ]
+        if to_create:
+            Attachment.create(to_create)
+
+    @api.model
+    def _l10n_ec_decompress_xml(self, raw, name=""):
+        """
+        Descomprime el xml, sin generar mas bytes que el tamaño original
+        indicado en la cabecera, y restaura los bloques compartidos
+        :param name: nombre del adjunto, para los mensajes de error
+        :return: bytes con el xml original
+        """
+        corrupted_error = UserError(
+            _("The compressed XML attachment %s is corrupted and can't be read") % name
+        )
+        if len(raw) < COMPRESSED_XML_HEADER_SIZE:
+            raise corrupted_error
+        original_size = struct.unpack(
+            ">Q", raw[len(COMPRESSED_XML_MAGIC) : COMPRESSED_XML_HEADER_SIZE]
+        )[0]
+        decompressor = zlib.decompressobj()
+        try:
+            # las referencias son mas cortas que los bloques,
+            # el contenido comprimido no puede superar el tamaño original,
+            # un byte mas para que zlib llegue al final del stream
+            content = decompressor.decompress(
+                raw[COMPRESSED_XML_HEADER_SIZE:], original_size + 1
+            )
+        except zlib.error:
+            raise corrupted_error from None
+        if (
+            not decompressor.eof
+            or decompressor.unconsumed_tail
+            or decompressor.unused_data
+        ):
+            raise corrupted_error
+        checksums = {
+            checksum.decode() for checksum in BLOCK_REFERENCE_PATTERN.findall(content)
+        }
+        blocks = self._l10n_ec_get_xml_blocks(checksums)
+        missing = checksums - set(blocks)
+        if missing:
+            raise UserError(
+                _(
+                    "The certificate block %(block)s of the compressed XML "
+                    "attachment %(name)s was not found, the attachment can't be read"
+                )
+                % {"block": ", ".join(sorted(missing)), "name": name}
+            )
+        xml_data = BLOCK_REFERENCE_PATTERN.sub(
+            lambda match: blocks[match.group(1).decode()], content
+        )
+        if len(xml_data) != original_size:
+            raise corrupted_error
+        return xml_data
+
+    @api.model
+    def _l10n_ec_get_xml_blocks(self, checksums):
+        """
+        :param checksums: sha1 de los bloques
+        :return: dict {sha1: bytes}
+        """
+        with _xml_blocks_lock:
+            blocks = {
+                checksum: _xml_blocks[checksum]
+                for checksum in checksums
+                if checksum in _xml_blocks
+            }
+        missing = checksums - set(blocks)
+        if missing:
+            for attachment in self.sudo().search(
+                [
+                    ("checksum", "in", list(missing)),
+                    ("name", "=like", f"{BLOCK_PREFIX}%"),
+                ]
+            ):
+                blocks[attachment.checksum] = attachment.raw
+            with _xml_blocks_lock:
+                _xml_blocks.update(blocks)
+        return blocks
+
+    @api.model
+    def _l10n_ec_get_xml_storage_report(self):
+        """
+        Espacio usado por los xml comprimidos, leyendo solo la cabecera
+        :return: dict con el numero de adjuntos comprimidos, su tamaño original,
+            el tamaño guardado(incluidos los bloques) y el porcentaje ahorrado
+        """
+        Attachment = self.sudo()
+        res = {
+            "attachments": 0,
+            "original_size": 0,
+            "stored_size": 0,
+            "blocks": 0,
+            "saved_percent": 0.0,
+        }
+        for attachment in Attachment.search([("l10n_ec_compressed_xml", "=", True)]):
+            header = attachment._l10n_ec_read_header()
+            if header[: len(COMPRESSED_XML_MAGIC)] != COMPRESSED_XML_MAGIC:
+                continue
+            res["attachments"] += 1
+            res["original_size"] += struct.unpack(
+                ">Q", header[len(COMPRESSED_XML_MAGIC) :]
+            )[0]
+            res["stored_size"] += attachment.file_size
+        blocks = Attachment.search([("name", "=like", f"{BLOCK_PREFIX}%")])
+        res["blocks"] = len(blocks)
+        res["stored_size"] += sum(blocks.mapped("file_size"))
+        if res["original_size"]:
+            res["saved_percent"] = round(
+                100.0 * (1 - res["stored_size"] / res["original_size"]), 2
+            )
+        _logger.info("Compressed XML storage: %s", res)
+        return res
+
+    def _l10n_ec_read_header(self):
+        self.ensure_one()
+        if not self.store_fname:
+            return (self.db_datas or b"")[:COMPRESSED_XML_HEADER_SIZE]
+        try:
+            with open(self._full_path(self.store_fname), "rb") as stored_file:
+                return stored_file.read(COMPRESSED_XML_HEADER_SIZE)
+        except OSError:
+            _logger.warning("Can't read attachment file %s", self.store_fname)
+            return b""
@@ -1,5 +1,7 @@
 from odoo import api, fields, models
 
+from .account_edi_document import XSD_FILES_DATA
+
 
 class ResCompany(models.Model):
     _inherit = "res.company"
@@ -51,6 +53,16 @@ class ResCompany(models.Model):
         default="1.0.0",
     )
 
+    def write(self, vals):
+        res = super().write(vals)
+        if vals.get("l10n_ec_key_type_id"):
+            self.sudo().mapped("l10n_ec_key_type_id").filtered(
+                lambda x: x.state == "valid"
+            )._warm_up_signing_material()
+        if any(field_name in vals for _key, field_name in XSD_FILES_DATA.values()):
+            self.env["account.edi.document"]._l10n_ec_load_xsd_schemas()
+        return res
+
     @api.model
     def l10n_ec_get_resolution_data(self, date=None):
         # TODO: implementar logica para devolver numero de resolucion
@@ -30,3 +30,9 @@ class ResConfigSettings(models.TransientModel):
         default=50.0,
         readonly=False,
     )
+    l10n_ec_edi_compress_xml = fields.Boolean(
+        string="Compress signed XML",
+        config_parameter="l10n_ec_edi_compress_xml",
+        help="Store the signed XML attachments compressed, "
+        "the certificate is stored only once",
+    )
@@ -6,3 +6,4 @@ from . import test_l10n_ec_edi_out_invoice
 from . import test_l10n_ec_edi_liquidation
 from . import test_l10n_ec_edi_credit_note
 from . import test_l10n_ec_edi_debit_note
+from . import test_l10n_ec_edi_benchmark
@@ -1,10 +1,201 @@
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+import requests
+from zeep.exceptions import Fault
+
+from odoo.exceptions import UserError
 from odoo.tests import tagged
 
 from odoo.addons.account.tests.common import TestAccountReconciliationCommon
 
+from ..cli.sri_simulator import SriSimulatorServer
+from ..models.account_edi_document import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RateLimiter,
+    call_ws,
+    edi_send_xml,
+    edi_send_xml_auth,
+    parse_response_auth,
+    parse_response_send,
+)
+from ..models.account_edi_format import _ws_clients
+from ..models.ir_attachment import BLOCK_PREFIX, COMPRESSED_XML_MAGIC
 from .test_edi_common import TestL10nECEdiCommon
 
 
+RECEPTION_RESPONSE = b"""<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+<soap:Body>
+<ns2:validarComprobanteResponse xmlns:ns2="http://ec.gob.sri.ws.recepcion">
+<RespuestaRecepcionComprobante>
+<estado>RECIBIDA</estado>
+<comprobantes/>
+</RespuestaRecepcionComprobante>
+</ns2:validarComprobanteResponse>
+</soap:Body>
+</soap:Envelope>"""
+
+
+AUTHORIZATION_RESPONSE = b"""<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+<soap:Body>
+<ns2:autorizacionComprobanteResponse xmlns:ns2="http://ec.gob.sri.ws.autorizacion">
+<RespuestaAutorizacionComprobante>
+<claveAccesoConsultada>0000000000000000000000000000000000000000000000001</claveAccesoConsultada>
+<numeroComprobantes>2</numeroComprobantes>
+<autorizaciones>
+<autorizacion>
+<estado>NO AUTORIZADO</estado>
+<ambiente>PRUEBAS</ambiente>
+<comprobante><![CDATA[<factura id="comprobante"></factura>]]></comprobante>
+<mensajes>
+<mensaje>
+<identificador>56</identificador>
+<mensaje>ERROR ESTABLECIMIENTO CERRADO</mensaje>
+<tipo>ERROR</tipo>
+</mensaje>
+</mensajes>
+</autorizacion>
+<autorizacion>
+<estado>AUTORIZADO</estado>
+<numeroAutorizacion>0000000000000000000000000000000000000000000000001</numeroAutorizacion>
+<fechaAutorizacion>2022-05-10T10:15:20.123-05:00</fechaAutorizacion>
+<ambiente>PRUEBAS</ambiente>
+<comprobante><![CDATA[<factura id="comprobante"></factura>]]></comprobante>
+<mensajes/>
+</autorizacion>
+</autorizaciones>
+</RespuestaAutorizacionComprobante>
+</ns2:autorizacionComprobanteResponse>
+</soap:Body>
+</soap:Envelope>"""
+
+
+SOAP_FAULT_RESPONSE = b"""<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+<soap:Body>
+<soap:Fault>
+<faultcode>soap:Server</faultcode>
+<faultstring>Clave de acceso mal formada</faultstring>
+</soap:Fault>
+</soap:Body>
+</soap:Envelope>"""
+
+
+class SriReceptionHandler(BaseHTTPRequestHandler):
+    """Servidor local que reemplaza a la recepcion del SRI"""
+
+    protocol_version = "HTTP/1.1"
+    paths = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.paths.append(self.path)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(RECEPTION_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RECEPTION_RESPONSE)
+
+    def log_message(self, format, *args):
+        return
+
+
+class FakeSriService:
+    """Webservice del SRI en memoria, registra las solicitudes simultaneas"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = []
+
+    def _call(self, name, response):
+        with self.lock:
+            self.calls.append(name)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return response
+
+    def validarComprobante(self, xml):
+        return self._call(
+            "validarComprobante", {"estado": "RECIBIDA", "comprobantes": None}
+        )
+
+    def autorizacionComprobante(self, claveAccesoComprobante):
+        return self._call(
+            "autorizacionComprobante",
+            {"autorizaciones": {"autorizacion": [{"estado": "AUTORIZADO"}]}},
+        )
+
+
+class FakeSriClient:
+    def __init__(self, service, circuit_breaker=None):
+        self.service = service
+        self.circuit_breaker = circuit_breaker
+
+
+class InProcessSriService(FakeSriService):
+    """Webservice del SRI que recibio los documentos pero aun no los autoriza"""
+
+    def autorizacionComprobante(self, claveAccesoComprobante):
+        return self._call(
+            "autorizacionComprobante",
+            {"autorizaciones": {"autorizacion": [{"estado": "EN PROCESO"}]}},
+        )
+
+
+class UnavailableSriService:
+    """Webservice del SRI que no responde"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def validarComprobante(self, xml):
+        self.calls += 1
+        raise requests.exceptions.ConnectTimeout("SRI no responde")
+
+    def autorizacionComprobante(self, claveAccesoComprobante):
+        self.calls += 1
+        raise requests.exceptions.ConnectTimeout("SRI no responde")
+
+
+class RawResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+class FaultSriService:
+    """Webservice del SRI que responde un SOAP Fault con estado 500"""
+
+    def validarComprobante(self, xml):
+        return RawResponse(500, SOAP_FAULT_RESPONSE)
+
+    def autorizacionComprobante(self, claveAccesoComprobante):
+        return RawResponse(500, SOAP_FAULT_RESPONSE)
+
+
+class RawSriClient(FakeSriClient):
+    """Cliente con la configuracion raw_response de zeep"""
+
+    @contextmanager
+    def settings(self, **kwargs):
+        yield
+
+
 @tagged("post_install", "-at_install")
 class TestAccountEdiFormat(TestL10nECEdiCommon, TestAccountReconciliationCommon):
     def test_is_required_for_invoice(self):
@@ -20,3 +211,570 @@ class TestAccountEdiFormat(TestL10nECEdiCommon, TestAccountReconciliationCommon)
         self.assertTrue(self.edi_format._is_required_for_invoice(invoice))
         # Comprobar si el edi_format es compatible con el diario
         self.assertTrue(self.edi_format._is_compatible_with_journal(invoice.journal_id))
+
+    def test_l10n_ec_ws_client_cache(self):
+        """Reutilizar el cliente del webservice del SRI entre solicitudes"""
+        edi_format = self.edi_format
+        edi_format._l10n_ec_refresh_edi_ws_clients()
+        clients = iter([object(), object(), None, object()])
+        with patch.object(
+            type(edi_format),
+            "_l10n_ec_create_edi_ws_client",
+            side_effect=lambda *args: next(clients),
+        ) as create_client:
+            client = edi_format._l10n_ec_get_edi_ws_client("test", "reception")
+            self.assertIs(
+                edi_format._l10n_ec_get_edi_ws_client("test", "reception"), client
+            )
+            self.assertEqual(create_client.call_count, 1)
+            # forzar la creacion de un nuevo cliente
+            new_client = edi_format._l10n_ec_get_edi_ws_client(
+                "test", "reception", force_refresh=True
+            )
+            self.assertIsNot(new_client, client)
+            # si el SRI no responde, se usa el cliente anterior
+            self.env["ir.config_parameter"].sudo().set_param("l10n_ec_ws_client_ttl", 0)
+            self.assertIs(
+                edi_format._l10n_ec_get_edi_ws_client("test", "reception"),
+                new_client,
+            )
+            self.assertEqual(create_client.call_count, 3)
+            # otra configuracion del pool http crea un cliente nuevo
+            ICP = self.env["ir.config_parameter"].sudo()
+            ICP.set_param("l10n_ec_ws_client_ttl", 3600)
+            ICP.set_param("l10n_ec_sri_pool_size", 20)
+            self.assertIsNot(
+                edi_format._l10n_ec_get_edi_ws_client("test", "reception"),
+                new_client,
+            )
+            self.assertEqual(create_client.call_count, 4)
+        edi_format._l10n_ec_refresh_edi_ws_clients("test")
+        self.assertFalse(
+            [key for key in _ws_clients if key[1:3] == ("test", "reception")]
+        )
+
+    def test_l10n_ec_ws_client_local_wsdl(self):
+        """Crear el cliente desde el wsdl local y enviar a la direccion configurada"""
+        server = HTTPServer(("127.0.0.1", 0), SriReceptionHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.env["ir.config_parameter"].sudo().set_param(
+            "l10n_ec_sri_test_reception_url",
+            f"http://127.0.0.1:{server.server_port}/RecepcionComprobantesOffline",
+        )
+        client = self.edi_format._l10n_ec_get_edi_ws_client("test", "reception")
+        response = client.service.validarComprobante(xml=b"<factura/>")
+        edi_doc = self.env["account.edi.document"]
+        ok, messages = edi_doc._l10n_ec_edi_process_response_send(response)
+        self.assertTrue(ok)
+        self.assertFalse(messages)
+        self.assertEqual(SriReceptionHandler.paths, ["/RecepcionComprobantesOffline"])
+        # las siguientes solicitudes reutilizan la conexion abierta
+        client.service.validarComprobante(xml=b"<factura/>")
+        client.service.validarComprobante(xml=b"<factura/>")
+        host_info = self.edi_format._l10n_ec_get_http_session_info()[
+            f"127.0.0.1:{server.server_port}"
+        ]
+        self.assertEqual(host_info["requests"], 3)
+        self.assertEqual(host_info["connections"], 1)
+        self.assertEqual(host_info["reused"], 2)
+
+    def test_l10n_ec_concurrent_submission(self):
+        """Enviar varios documentos al SRI al mismo tiempo"""
+        service = FakeSriService()
+        client = FakeSriClient(service)
+        edi_docs = [
+            (
+                self.env["account.edi.document"].new(
+                    {"l10n_ec_xml_access_key": str(index).zfill(49)}
+                ),
+                b"<factura/>",
+            )
+            for index in range(8)
+        ]
+        self.env["ir.config_parameter"].sudo().set_param(
+            "l10n_ec_sri_concurrent_requests", 4
+        )
+        results = self.edi_format._l10n_ec_edi_submit_documents(
+            client, client, edi_docs
+        )
+        self.assertEqual(len(results), 8)
+        self.assertGreater(service.max_in_flight, 1)
+        self.assertLessEqual(service.max_in_flight, 4)
+        for (edi_doc, _xml_signed), result in zip(edi_docs, results):
+            self.assertTrue(result["sent_date"])
+            errors, _retry = self.edi_format._l10n_ec_edi_process_submission(
+                edi_doc, result
+            )
+            self.assertFalse(errors)
+            self.assertTrue(edi_doc.l10n_ec_last_sent_date)
+            self.assertTrue(edi_doc.l10n_ec_authorization_date)
+
+    def test_l10n_ec_submission_per_environment(self):
+        """Enviar en un solo lote documentos de varios ambientes"""
+        test_service = FakeSriService(delay=0)
+        production_service = FakeSriService(delay=0)
+        test_client = FakeSriClient(test_service)
+        production_client = FakeSriClient(production_service)
+        edi_docs = [
+            (
+                self.env["account.edi.document"].new(
+                    {"l10n_ec_xml_access_key": str(index).zfill(49)}
+                ),
+                b"<factura/>",
+            )
+            + (index % 2 and (production_client, production_client) or ())
+            for index in range(4)
+        ]
+        results = self.edi_format._l10n_ec_edi_submit_documents(
+            test_client, test_client, iter(edi_docs)
+        )
+        self.assertEqual(len(results), 4)
+        self.assertEqual(
+            test_service.calls,
+            ["validarComprobante", "autorizacionComprobante"] * 2,
+        )
+        self.assertEqual(
+            production_service.calls,
+            ["validarComprobante", "autorizacionComprobante"] * 2,
+        )
+        for result in results:
+            self.assertTrue(result["sent_date"])
+
+    def test_l10n_ec_two_phase_submission(self):
+        """Enviar todos los documentos y luego consultar su autorizacion"""
+        service = FakeSriService(delay=0)
+        client = FakeSriClient(service)
+        edi_docs = [
+            (
+                self.env["account.edi.document"].new(
+                    {"l10n_ec_xml_access_key": str(index).zfill(49)}
+                ),
+                b"<factura/>",
+            )
+            for index in range(4)
+        ]
+        ICP = self.env["ir.config_parameter"].sudo()
+        ICP.set_param("l10n_ec_sri_two_phase_submission", "True")
+        ICP.set_param("l10n_ec_sri_authorization_delay", 0.1)
+        start = time.monotonic()
+        results = self.edi_format._l10n_ec_edi_submit_documents(
+            client, client, edi_docs
+        )
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(
+            service.calls,
+            ["validarComprobante"] * 4 + ["autorizacionComprobante"] * 4,
+        )
+        for (edi_doc, _xml_signed), result in zip(edi_docs, results):
+            errors, _retry = self.edi_format._l10n_ec_edi_process_submission(
+                edi_doc, result
+            )
+            self.assertFalse(errors)
+            self.assertTrue(edi_doc.l10n_ec_authorization_date)
+
+    def test_l10n_ec_pending_authorization(self):
+        """Reintentar los documentos recibidos por el SRI aun sin autorizar"""
+        service = InProcessSriService(delay=0)
+        client = FakeSriClient(service)
+        edi_doc = self.env["account.edi.document"].new(
+            {"l10n_ec_xml_access_key": "1".zfill(49)}
+        )
+        ICP = self.env["ir.config_parameter"].sudo()
+        ICP.set_param("l10n_ec_sri_two_phase_submission", "True")
+        ICP.set_param("l10n_ec_sri_authorization_delay", 0)
+        results = self.edi_format._l10n_ec_edi_submit_documents(
+            client, client, [(edi_doc, b"<factura/>")]
+        )
+        errors, retry = self.edi_format._l10n_ec_edi_process_submission(
+            edi_doc, results[0]
+        )
+        self.assertTrue(retry)
+        self.assertIn("pending authorization", "".join(errors))
+        self.assertTrue(edi_doc.l10n_ec_last_sent_date)
+        self.assertFalse(edi_doc.l10n_ec_authorization_date)
+        # sin respuesta de la recepcion tambien se reintenta, sin errores de codigo
+        edi_doc = self.env["account.edi.document"].new(
+            {"l10n_ec_xml_access_key": "2".zfill(49)}
+        )
+        errors, retry = self.edi_format._l10n_ec_edi_process_submission(
+            edi_doc,
+            {
+                "auth_before": False,
+                "send": False,
+                "sent_date": False,
+                "auth": False,
+                "send_skipped": False,
+            },
+        )
+        self.assertTrue(retry)
+        self.assertIn("Can't connect to SRI Webservice", "".join(errors))
+        # los errores del envio no se reportan como errores del xml
+        errors, retry = self.edi_format._l10n_ec_edi_process_submission(
+            edi_doc, requests.exceptions.ConnectTimeout("SRI no responde")
+        )
+        self.assertIn("EDI Error sending the document to SRI", "".join(errors))
+        self.assertNotIn("creating xml file", "".join(errors))
+
+    def test_l10n_ec_resume_received_document(self):
+        """Continuar un documento ya recibido consultando solo su autorizacion"""
+        service = InProcessSriService(delay=0)
+        client = FakeSriClient(service)
+        xml_signed = b"<factura/>"
+        attachment = self.env["ir.attachment"].create(
+            {"name": "factura.xml", "raw": xml_signed}
+        )
+        edi_doc = self.env["account.edi.document"].new(
+            {
+                "l10n_ec_xml_access_key": "1".zfill(49),
+                "l10n_ec_last_sent_date": datetime.now(),
+                "l10n_ec_edi_stage": "received",
+                "l10n_ec_signed_xml_hash": hashlib.sha256(xml_signed).hexdigest(),
+                "attachment_id": attachment.id,
+            }
+        )
+        self.assertEqual(edi_doc._l10n_ec_get_checkpoint_xml(), xml_signed)
+        results = self.edi_format._l10n_ec_edi_submit_documents(
+            client, client, [(edi_doc, xml_signed)]
+        )
+        self.assertEqual(service.calls, ["autorizacionComprobante"])
+        self.assertTrue(results[0]["send_skipped"])
+        # EN PROCESO, se reintentara sin marcar el documento como enviado
+        errors, retry = self.edi_format._l10n_ec_edi_process_submission(
+            edi_doc, results[0]
+        )
+        self.assertTrue(retry)
+        self.assertIn("pending authorization", "".join(errors))
+        self.assertEqual(edi_doc.l10n_ec_edi_stage, "received")
+        # si el adjunto cambio, el xml se debe generar y firmar nuevamente
+        attachment.raw = b"<factura><secuencial>1</secuencial></factura>"
+        self.assertFalse(edi_doc._l10n_ec_get_checkpoint_xml())
+
+    def test_l10n_ec_save_attachments(self):
+        """Guardar los xml firmados de varios documentos juntos"""
+        self._setup_edi_company_ec()
+        signed_documents = []
+        for index in range(3):
+            invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+            signed_documents.append(
+                (
+                    invoice,
+                    invoice._get_edi_document(self.edi_format),
+                    b"<factura><secuencial>%d</secuencial></factura>" % index,
+                    "hash%d" % index,
+                )
+            )
+        attachments = self.edi_format._l10n_ec_edi_save_attachments(signed_documents)
+        self.assertEqual(len(attachments), 3)
+        for invoice, edi_doc, xml_signed, render_hash in signed_documents:
+            self.assertEqual(attachments[edi_doc].raw, xml_signed)
+            self.assertEqual(attachments[edi_doc].res_id, invoice.id)
+            self.assertEqual(edi_doc.attachment_id, attachments[edi_doc])
+            self.assertEqual(edi_doc.l10n_ec_edi_stage, "signed")
+            self.assertEqual(edi_doc.l10n_ec_render_hash, render_hash)
+            self.assertEqual(edi_doc._l10n_ec_get_checkpoint_xml(), xml_signed)
+
+    def test_l10n_ec_compressed_xml_attachments(self):
+        """Guardar los xml firmados comprimidos, con el certificado una sola vez"""
+        self._setup_edi_company_ec()
+        self.env["ir.config_parameter"].sudo().set_param(
+            "l10n_ec_edi_compress_xml", "True"
+        )
+        certificate = b"MIIC" + b"A" * 2000
+        signed_documents = []
+        for index in range(3):
+            invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+            xml_signed = (
+                b'<factura id="comprobante">\n  <secuencial>%d</secuencial>\n'
+                b'  <ds:Signature xmlns:ds="http://www.w3.org/2000/09/xmldsig#">\n'
+                b'    <ds:KeyInfo Id="Certificate%d">\n'
+                b"      <ds:X509Data><ds:X509Certificate>%s"
+                b"</ds:X509Certificate></ds:X509Data>\n"
+                b"    </ds:KeyInfo>\n  </ds:Signature>\n</factura>\n"
+            ) % (index, 100000 + index, certificate)
+            signed_documents.append(
+                (invoice, invoice._get_edi_document(self.edi_format), xml_signed, "")
+            )
+        attachments = self.edi_format._l10n_ec_edi_save_attachments(signed_documents)
+        attachments[signed_documents[0][1]].invalidate_cache()
+        for _invoice, edi_doc, xml_signed, _render_hash in signed_documents:
+            attachment = attachments[edi_doc]
+            self.assertLess(attachment.file_size, len(xml_signed) / 4)
+            self.assertEqual(attachment.raw, xml_signed)
+            self.assertEqual(edi_doc._l10n_ec_get_checkpoint_xml(), xml_signed)
+            self.assertTrue(attachment.l10n_ec_compressed_xml)
+        # el certificado se guarda una sola vez, ligado a la company
+        blocks = self.env["ir.attachment"].search(
+            [("name", "=like", f"{BLOCK_PREFIX}%")]
+        )
+        self.assertEqual(blocks.res_model, "res.company")
+        self.assertEqual(blocks.res_id, signed_documents[0][0].company_id.id)
+        with self.assertRaises(UserError):
+            blocks.unlink()
+        # la copia en otro modelo se sigue leyendo descomprimida
+        attachment = attachments[signed_documents[0][1]]
+        attachment_copy = attachment.copy({"res_model": "res.partner", "res_id": 1})
+        self.assertEqual(attachment_copy.raw, signed_documents[0][2])
+        report = self.env["ir.attachment"]._l10n_ec_get_xml_storage_report()
+        self.assertGreaterEqual(report["attachments"], 3)
+        self.assertGreaterEqual(report["blocks"], 1)
+        self.assertGreater(report["saved_percent"], 0)
+
+    def test_l10n_ec_compressed_xml_errors(self):
+        """Descomprimir solo los adjuntos propios, con un tamaño limitado"""
+        Attachment = self.env["ir.attachment"]
+
+        def compressed(content, original_size):
+            return (
+                COMPRESSED_XML_MAGIC
+                + struct.pack(">Q", original_size)
+                + zlib.compress(content)
+            )
+
+        # sin la marca del modulo el contenido no se descomprime
+        raw = compressed(b"<factura/>", 10)
+        attachment = Attachment.create(
+            {"name": "otro.xml", "raw": raw, "res_model": "account.move"}
+        )
+        self.assertEqual(attachment.raw, raw)
+        # contenido mayor al indicado en la cabecera
+        with self.assertRaisesRegex(UserError, "corrupted"):
+            Attachment._l10n_ec_decompress_xml(compressed(b"A" * 10000, 10), "a.xml")
+        with self.assertRaisesRegex(UserError, "corrupted"):
+            Attachment._l10n_ec_decompress_xml(COMPRESSED_XML_MAGIC + b"x", "a.xml")
+        # bloque eliminado
+        content = b"<factura>\x00BLOCK:%s\x00</factura>" % (b"0" * 40)
+        with self.assertRaisesRegex(UserError, "was not found"):
+            Attachment._l10n_ec_decompress_xml(compressed(content, 100), "a.xml")
+
+    def test_l10n_ec_circuit_breaker(self):
+        """Dejar de enviar al SRI luego de varios errores de conexion"""
+        service = UnavailableSriService()
+        client = FakeSriClient(service, CircuitBreaker("test", 2, cool_down=0.1))
+        edi_docs = [
+            (
+                self.env["account.edi.document"].new(
+                    {"l10n_ec_xml_access_key": str(index).zfill(49)}
+                ),
+                b"<factura/>",
+            )
+            for index in range(5)
+        ]
+        results = self.edi_format._l10n_ec_edi_submit_documents(
+            client, client, edi_docs
+        )
+        # los 2 primeros fallan por timeout, los demas sin llamar al SRI
+        self.assertEqual(service.calls, 2)
+        self.assertIsInstance(results[0], dict)
+        self.assertIsInstance(results[1], dict)
+        for result in results[2:]:
+            self.assertIsInstance(result, CircuitOpenError)
+        self.assertEqual(client.circuit_breaker.state, "open")
+        # luego del tiempo de espera se permite una solicitud de prueba
+        time.sleep(0.1)
+        client.service = FakeSriService(delay=0)
+        results = self.edi_format._l10n_ec_edi_submit_documents(
+            client, client, edi_docs[:1]
+        )
+        self.assertTrue(results[0]["sent_date"])
+        self.assertEqual(client.circuit_breaker.state, "closed")
+
+    def test_l10n_ec_soap_fault(self):
+        """Mostrar el mensaje del SOAP Fault sin abrir el circuit breaker"""
+        client = RawSriClient(
+            FaultSriService(), CircuitBreaker("test", 1, cool_down=60)
+        )
+        with self.assertRaises(Fault):
+            call_ws(client, "validarComprobante", xml=b"<factura/>")
+        self.assertEqual(client.circuit_breaker.state, "closed")
+        access_key = "0" * 49
+        response = edi_send_xml(client, access_key, b"<factura/>")
+        ok, messages = parse_response_send(response)
+        self.assertFalse(ok)
+        self.assertEqual(messages, ["ERROR [soap:Server] Clave de acceso mal formada "])
+        response = edi_send_xml_auth(client, access_key)
+        ok, messages, _authorization_date, _authorization = parse_response_auth(
+            response
+        )
+        self.assertFalse(ok)
+        self.assertEqual(messages, ["ERROR [soap:Server] Clave de acceso mal formada "])
+        self.assertEqual(client.circuit_breaker.state, "closed")
+
+    def test_l10n_ec_sri_simulator(self):
+        """Enviar al simulador local del SRI con los clientes del modulo"""
+        server = SriSimulatorServer(
+            ("127.0.0.1", 0), processing_time=0.2, devuelta_rate=0.5, seed=1
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        ICP = self.env["ir.config_parameter"].sudo()
+        for url_type in ("reception", "authorization"):
+            ICP.set_param(
+                f"l10n_ec_sri_test_{url_type}_url",
+                f"http://127.0.0.1:{server.server_port}/",
+            )
+        ICP.set_param("l10n_ec_sri_concurrent_requests", 4)
+        ICP.set_param("l10n_ec_sri_two_phase_submission", "True")
+        ICP.set_param("l10n_ec_sri_authorization_delay", 0.2)
+        client_send = self.edi_format._l10n_ec_get_edi_ws_client("test", "reception")
+        auth_client = self.edi_format._l10n_ec_get_edi_ws_client(
+            "test", "authorization"
+        )
+        edi_docs = []
+        for index in range(10):
+            access_key = str(index).zfill(49)
+            edi_docs.append(
+                (
+                    self.env["account.edi.document"].new(
+                        {"l10n_ec_xml_access_key": access_key}
+                    ),
+                    b"<factura><infoTributaria><claveAcceso>%s</claveAcceso>"
+                    b"</infoTributaria></factura>" % access_key.encode(),
+                )
+            )
+        results = self.edi_format._l10n_ec_edi_submit_documents(
+            client_send, auth_client, edi_docs
+        )
+        stats = server.info()
+        self.assertEqual(stats["validarComprobante"], 10)
+        self.assertEqual(stats["RECIBIDA"] + stats["DEVUELTA"], 10)
+        self.assertEqual(stats["AUTORIZADO"], stats["RECIBIDA"])
+        authorized = 0
+        for (edi_doc, _xml_signed), result in zip(edi_docs, results):
+            errors, _retry = self.edi_format._l10n_ec_edi_process_submission(
+                edi_doc, result
+            )
+            if edi_doc.l10n_ec_authorization_date:
+                authorized += 1
+                self.assertFalse(errors)
+                self.assertEqual(
+                    edi_doc.l10n_ec_authorization_number,
+                    edi_doc.l10n_ec_xml_access_key,
+                )
+                self.assertTrue(edi_doc.l10n_ec_authorized_xml)
+            else:
+                self.assertIn("ARCHIVO NO CUMPLE ESTRUCTURA XML", "".join(errors))
+        self.assertEqual(authorized, stats["RECIBIDA"])
+
+    def test_l10n_ec_rate_limiter(self):
+        """Limitar las solicitudes por segundo al SRI entre varios hilos"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            limiter = RateLimiter(os.path.join(tmp_dir, "0999999999001_reception"), 20)
+            start = time.monotonic()
+            threads = [
+                threading.Thread(
+                    target=lambda: [limiter.acquire() for _index in range(5)]
+                )
+                for _thread in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # 10 solicitudes a 20 por segundo, la primera sin esperar
+            self.assertGreaterEqual(time.monotonic() - start, 0.4)
+        self.assertIsNone(
+            self.edi_format._l10n_ec_get_rate_limiter("0999999999001", "reception")
+        )
+        self.env["ir.config_parameter"].sudo().set_param("l10n_ec_sri_rate_limit", 5)
+        limiter = self.edi_format._l10n_ec_get_rate_limiter(
+            "0999999999001", "reception"
+        )
+        self.assertEqual(limiter.rate, 5)
+        self.assertTrue(limiter.path.endswith("0999999999001_reception"))
+
+    def test_l10n_ec_parse_raw_response(self):
+        """Leer el xml de las respuestas del SRI sin procesarlas con zeep"""
+        self.assertEqual(parse_response_send(RECEPTION_RESPONSE), (True, []))
+        ok, messages, authorization_date, authorization = parse_response_auth(
+            AUTHORIZATION_RESPONSE
+        )
+        self.assertTrue(ok)
+        self.assertFalse(messages)
+        self.assertEqual(
+            authorization,
+            {
+                "numeroAutorizacion": "0" * 48 + "1",
+                "comprobante": '<factura id="comprobante"></factura>',
+            },
+        )
+        self.assertEqual(
+            authorization_date.replace(tzinfo=None),
+            datetime(2022, 5, 10, 15, 15, 20, 123000),
+        )
+        ok, messages, authorization_date, authorization = parse_response_auth(
+            AUTHORIZATION_RESPONSE.replace(b">AUTORIZADO<", b">EN PROCESO<")
+        )
+        self.assertFalse(ok)
+        self.assertEqual(messages, ["ERROR [56] ERROR ESTABLECIMIENTO CERRADO "])
+        # las entidades de la respuesta no se resuelven
+        ok, messages = parse_response_send(
+            b'<?xml version="1.0"?>'
+            b'<!DOCTYPE soap:Envelope [<!ENTITY estado "RECIBIDA">]>'
+            + RECEPTION_RESPONSE.replace(b">RECIBIDA<", b">&estado;<")
+        )
+        self.assertFalse(ok)
+
+    def test_l10n_ec_refresh_authorization_status(self):
+        """Consultar la autorizacion de varios documentos por bloques"""
+        server = SriSimulatorServer(("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        ICP = self.env["ir.config_parameter"].sudo()
+        ICP.set_param(
+            "l10n_ec_sri_test_authorization_url",
+            f"http://127.0.0.1:{server.server_port}/",
+        )
+        ICP.set_param("l10n_ec_sri_refresh_chunk_size", 2)
+        ICP.set_param("l10n_ec_sri_concurrent_requests", 2)
+        invoice = self._l10n_ec_create_in_invoice()
+        invoice.company_id.l10n_ec_type_environment = "test"
+        edi_docs = self.env["account.edi.document"]
+        for index in range(5):
+            access_key = str(index).zfill(49)
+            edi_docs |= self.env["account.edi.document"].create(
+                {
+                    "move_id": invoice.id,
+                    "edi_format_id": self.edi_format.id,
+                    "state": "to_send",
+                    "l10n_ec_xml_access_key": access_key,
+                    "l10n_ec_edi_stage": "received",
+                }
+            )
+            # los documentos pares fueron autorizados por el SRI
+            if index % 2 == 0:
+                server.documents[access_key] = (0, b"<factura/>", "AUTORIZADO")
+            elif index == 1:
+                server.documents[access_key] = (0, b"<factura/>", "NO AUTORIZADO")
+        res = edi_docs._l10n_ec_refresh_authorization_status(
+            [("id", "in", edi_docs.ids)]
+        )
+        self.assertEqual(res, {"checked": 5, "authorized": 3})
+        self.assertEqual(server.info()["autorizacionComprobante"], 5)
+        for index, edi_doc in enumerate(edi_docs):
+            self.assertEqual(bool(edi_doc.l10n_ec_authorization_number), index % 2 == 0)
+        # el rechazado se debe generar nuevamente, ya no se consulta
+        self.assertFalse(edi_docs[1].l10n_ec_edi_stage)
+        self.assertEqual(edi_docs[3].l10n_ec_edi_stage, "received")
+        with patch.object(
+            type(edi_docs), "_l10n_ec_refresh_authorization_status"
+        ) as refresh:
+            edi_docs._cron_l10n_ec_refresh_authorization_status()
+        self.assertIn(("l10n_ec_edi_stage", "=", "received"), refresh.call_args[0][0])
+        self.assertEqual(edi_docs[0]._l10n_ec_get_authorized_xml(), b"<factura/>")
+        # los autorizados con el xml guardado no se consultan nuevamente
+        res = edi_docs._l10n_ec_refresh_authorization_status(
+            [("id", "in", edi_docs.ids)]
+        )
+        self.assertEqual(res, {"checked": 5, "authorized": 3})
+        self.assertEqual(server.info()["autorizacionComprobante"], 7)
+        self.assertEqual(
+            edi_docs[0]._l10n_ec_get_ride_authorization_data(),
+            {
+                "authorization_number": edi_docs[0].l10n_ec_authorization_number,
+                "access_key": "0" * 49,
+            },
+        )
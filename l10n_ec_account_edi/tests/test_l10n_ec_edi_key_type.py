@@ -1,6 +1,25 @@
+import os
+import tempfile
+import threading
+from unittest.mock import MagicMock, patch
+
+import xmlsig  # pylint: disable=W7936
+from lxml import etree
+from xades import XAdESContext  # pylint: disable=W7936
+from xades.policy import ImpliedPolicy  # pylint: disable=W7936
+
 from odoo.exceptions import UserError
 from odoo.tests import tagged
+from odoo.tools import config
 
+from ..cli.sri_signer import SigningService, parse_key
+from ..models.sri_key_type import (
+    OID_PKCS12_SHROUDED_KEY_BAG,
+    _der_items,
+    certificate_cache,
+    get_signing_private_key,
+    sign_xml_tree,
+)
 from .test_edi_common import TestL10nECEdiCommon
 
 
@@ -16,3 +35,180 @@ class TestL10nECKeyType(TestL10nECEdiCommon):
         self.certificate.password = "invalid"
         with self.assertRaises(UserError):
             self.certificate.action_validate_and_load()
+
+    def test_l10n_ec_signing_key_fallback(self):
+        # Sin poder leer las claves privadas, usar la clave del archivo
+        # solo cuando es la unica, con varias no se sabe cual es la de firma
+        p12 = MagicMock()
+        key_bag = b"\x06\x0b" + OID_PKCS12_SHROUDED_KEY_BAG
+        with patch(
+            "odoo.addons.l10n_ec_account_edi.models.sri_key_type"
+            ".load_pkcs12_private_keys",
+            side_effect=ValueError("Indefinite length encoding is not supported"),
+        ):
+            self.assertIs(
+                get_signing_private_key(b"\x30" + key_bag, b"", p12, "Firma"),
+                p12.key,
+            )
+            with self.assertRaises(UserError):
+                get_signing_private_key(key_bag + key_bag, b"", p12, "Firma")
+
+    def test_l10n_ec_der_items(self):
+        # Elementos DER y BER de longitud indefinida, rechazando datos truncados
+        self.assertEqual(
+            list(_der_items(b"\x02\x01\x05\x04\x02ab")),
+            [(0x02, b"\x05", b"\x02\x01\x05"), (0x04, b"ab", b"\x04\x02ab")],
+        )
+        ber = b"\x30\x80\x02\x01\x05\x30\x80\x04\x01a\x00\x00\x00\x00"
+        tag, content, raw = next(_der_items(ber))
+        self.assertEqual((tag, raw), (0x30, ber))
+        self.assertEqual(
+            [item[0] for item in _der_items(content)],
+            [0x02, 0x30],
+        )
+        for truncated in (b"\x30", b"\x04\x05ab", b"\x30\x80\x02\x01\x05"):
+            with self.assertRaises(ValueError):
+                list(_der_items(truncated))
+
+    def test_l10n_ec_certificate_cache(self):
+        # El material de firma se decodifica una sola vez
+        # y se invalida al cambiar el archivo o la contraseña
+        private_key, certificate = self.certificate._decode_certificate()
+        cache_info = self.certificate._get_certificate_cache_info()
+        self.assertEqual(
+            self.certificate._decode_certificate(), (private_key, certificate)
+        )
+        self.assertEqual(
+            self.certificate._get_certificate_cache_info()["hits"],
+            cache_info["hits"] + 1,
+        )
+        old_checksum = self.certificate.content_checksum
+        self.certificate.password = "invalid"
+        self.assertNotEqual(self.certificate.content_checksum, old_checksum)
+        with self.assertRaises(UserError):
+            self.certificate._decode_certificate()
+
+    def test_l10n_ec_sign_batch(self):
+        # Firmar varios documentos en paralelo, manteniendo el orden
+        # y reportando el error de cada documento
+        self.certificate.action_validate_and_load()
+        xml_documents = [
+            f'<factura id="comprobante"><secuencial>{sequence}</secuencial></factura>'
+            for sequence in range(3)
+        ]
+        xml_documents.append("<factura")
+        # el pool de procesos solo se usa en modo prefork
+        with patch.dict(config.options, {"workers": 2}):
+            results = self.certificate.action_sign_batch(xml_documents, max_workers=2)
+        self.assertEqual(len(results), 4)
+        for sequence, (xml_signed, error) in enumerate(results[:3]):
+            self.assertFalse(error)
+            self.assertIn(f"<secuencial>{sequence}</secuencial>", xml_signed)
+            self.assertIn("ds:Signature", xml_signed)
+        self.assertFalse(results[3][0])
+        self.assertTrue(results[3][1])
+
+    def test_l10n_ec_check_and_sign_pool(self):
+        # Validar contra el xsd y firmar en el pool de procesos
+        self.certificate.action_validate_and_load()
+        xsd_schema = etree.XMLSchema(
+            etree.fromstring(
+                '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">'
+                '<xs:element name="factura"><xs:complexType><xs:sequence>'
+                '<xs:element name="ruc" type="xs:integer"/>'
+                '</xs:sequence><xs:attribute name="id"/>'
+                "</xs:complexType></xs:element></xs:schema>"
+            )
+        )
+        xsd_key = ("invoice", "1.1.0")
+        valid_xml = '<factura id="comprobante"><ruc>1</ruc></factura>'
+        invalid_xml = '<factura id="comprobante"><ruc>A</ruc></factura>'
+        with self.certificate._get_sign_process_pool(
+            2, {xsd_key: xsd_schema}
+        ) as executor:
+            futures = [
+                self.certificate._submit_check_and_sign(
+                    executor, valid_xml, xsd_key, True
+                ),
+                self.certificate._submit_check_and_sign(
+                    executor, invalid_xml, xsd_key, True
+                ),
+                self.certificate._submit_check_and_sign(
+                    executor, invalid_xml, xsd_key, False
+                ),
+            ]
+            results = [future.result() for future in futures]
+        xml_signed, error = results[0]
+        self.assertFalse(error)
+        self.assertIn(b"ds:Signature", xml_signed)
+        self.assertFalse(results[1][0])
+        self.assertEqual(results[1][1][0], "xsd")
+        # sin validacion estricta el documento se firma igual
+        self.assertFalse(results[2][1])
+        self.assertIn(b"ds:Signature", results[2][0])
+
+    def test_l10n_ec_sign_tree(self):
+        # Firmar el arbol xml directamente, sin parsear ni serializar
+        self.certificate.action_validate_and_load()
+        xml_tree = etree.fromstring('<factura id="comprobante"><ruc>1</ruc></factura>')
+        self.assertIs(self.certificate.action_sign_tree(xml_tree), xml_tree)
+        signature = xml_tree.find("{http://www.w3.org/2000/09/xmldsig#}Signature")
+        self.assertIsNotNone(signature)
+
+    def test_l10n_ec_sign_tree_verify(self):
+        # La firma generada desde el prototipo del certificado
+        # debe pasar la verificacion XAdES completa, en cada documento
+        self.certificate.action_validate_and_load()
+        p12 = self.certificate._decode_certificate()
+        for sequence in range(2):
+            doc = sign_xml_tree(
+                etree.fromstring(
+                    f'<factura id="comprobante"><secuencial>{sequence}</secuencial>'
+                    "</factura>"
+                ),
+                p12,
+            )
+            signature = doc.find("ds:Signature", namespaces=xmlsig.constants.NS_MAP)
+            ctx = XAdESContext(ImpliedPolicy(xmlsig.constants.TransformSha1))
+            ctx.load_pkcs12(p12)
+            ctx.verify(signature)
+
+    def test_l10n_ec_signing_service(self):
+        # Delegar la firma al servicio compartido mediante socket unix
+        self.certificate.action_validate_and_load()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            socket_path = os.path.join(tmp_dir, "sri_signer.sock")
+            server = SigningService(socket_path, workers=2)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with patch.dict(
+                    config.options, {"l10n_ec_signing_service_socket": socket_path}
+                ):
+                    xml_tree = etree.fromstring(
+                        '<factura id="comprobante"><ruc>1</ruc></factura>'
+                    )
+                    self.certificate.action_sign_tree(xml_tree)
+                    service_info = self.certificate._get_signing_service_info()
+            finally:
+                server.shutdown()
+                server.server_close()
+        self.assertIsNotNone(
+            xml_tree.find("{http://www.w3.org/2000/09/xmldsig#}Signature")
+        )
+        self.assertEqual(service_info["requests"], 1)
+        self.assertEqual(service_info["keys"]["entries"], 1)
+        # el nombre de la base de datos puede contener ":"
+        self.assertEqual(parse_key("db:prod:7:abc"), ("db:prod", "7", "abc"))
+
+    def test_l10n_ec_warm_up_certificates(self):
+        # Los certificados validos de las compañias quedan decodificados
+        self.certificate.action_validate_and_load()
+        self.company.l10n_ec_key_type_id = self.certificate
+        certificate_cache.clear()
+        self.env["sri.key.type"]._warm_up_certificates()
+        cache_info = self.certificate._get_certificate_cache_info()
+        self.certificate._decode_certificate()
+        self.assertEqual(
+            self.certificate._get_certificate_cache_info()["hits"],
+            cache_info["hits"] + 1,
+        )
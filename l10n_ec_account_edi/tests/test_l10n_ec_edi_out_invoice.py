@@ -1,9 +1,16 @@
+import base64
+import gzip
 import logging
 from datetime import timedelta
+from unittest.mock import patch
+
+import xmlsig  # pylint: disable=W7936
+from lxml import etree
 
 from odoo import _
 from odoo.exceptions import UserError
 from odoo.tests import Form, tagged
+from odoo.tools import config
 
 from .test_edi_common import TestL10nECEdiCommon
 
@@ -214,3 +221,260 @@ class TestL10nClDte(TestL10nECEdiCommon):
                 line.quantity = 0
         with self.assertRaises(UserError):
             invoice.action_post()
+
+    def test_l10n_ec_xsd_schema_cache(self):
+        """Los esquemas xsd se compilan una sola vez por proceso"""
+        self._setup_edi_company_ec()
+        invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+        edi_doc = invoice._get_edi_document(self.edi_format)
+        xsd_schema = edi_doc._l10n_ec_get_xsd_schema()
+        cache_info = edi_doc._l10n_ec_get_xsd_cache_info()
+        self.assertIs(edi_doc._l10n_ec_get_xsd_schema(), xsd_schema)
+        self.assertEqual(
+            edi_doc._l10n_ec_get_xsd_cache_info()["hits"], cache_info["hits"] + 1
+        )
+        self.assertTrue(
+            edi_doc._l10n_ec_action_check_xsd(edi_doc._l10n_ec_render_xml_edi())
+        )
+
+    def test_l10n_ec_reuse_signed_xml(self):
+        """Reutilizar el xml firmado mientras los datos no cambien"""
+        self._setup_edi_company_ec()
+        invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+        edi_doc = invoice._get_edi_document(self.edi_format)
+        render_data = edi_doc._l10n_ec_get_xml_edi_render_data()
+        render_hash = edi_doc._l10n_ec_get_render_hash(render_data)
+        self.assertEqual(
+            edi_doc._l10n_ec_get_render_hash(
+                edi_doc._l10n_ec_get_xml_edi_render_data()
+            ),
+            render_hash,
+        )
+        xml_signed = b'<factura id="comprobante"/>'
+        self.edi_format._l10n_ec_edi_save_attachment(
+            invoice, edi_doc, xml_signed, render_hash
+        )
+        edi_doc.l10n_ec_edi_stage = False
+        self.assertEqual(
+            self.edi_format._l10n_ec_edi_get_reusable(edi_doc)[0], xml_signed
+        )
+        self.assertEqual(edi_doc.l10n_ec_edi_stage, "signed")
+        # con datos diferentes se debe generar y firmar nuevamente
+        edi_doc.l10n_ec_edi_stage = False
+        invoice.commercial_partner_id.street = "Otra direccion"
+        xml_signed, render_data, new_hash = self.edi_format._l10n_ec_edi_get_reusable(
+            edi_doc
+        )
+        self.assertFalse(xml_signed)
+        self.assertNotEqual(new_hash, render_hash)
+        # la version del xml y el certificado tambien cambian el hash
+        invoice.company_id.l10n_ec_invoice_version = "1.0.0"
+        version_hash = edi_doc._l10n_ec_get_render_hash(render_data)
+        self.assertNotEqual(version_hash, new_hash)
+        with patch.object(
+            type(self.certificate), "content_checksum", "otro certificado"
+        ):
+            self.assertNotEqual(
+                edi_doc._l10n_ec_get_render_hash(render_data), version_hash
+            )
+
+    def test_l10n_ec_skip_authorized_document(self):
+        """No firmar ni enviar al SRI los documentos ya autorizados"""
+        self._setup_edi_company_ec()
+        invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+        edi_doc = invoice._get_edi_document(self.edi_format)
+        self.edi_format._l10n_ec_edi_save_attachment(
+            invoice, edi_doc, b'<factura id="comprobante"/>'
+        )
+        edi_doc.write(
+            {
+                "l10n_ec_edi_stage": "authorized",
+                "l10n_ec_authorized_xml": base64.b64encode(
+                    gzip.compress(b'<factura id="comprobante"/>')
+                ),
+            }
+        )
+        document_errors = {}
+        document_attachments = {}
+        prepared = list(
+            self.edi_format._l10n_ec_edi_prepare_documents(
+                invoice, invoice.company_id, document_errors, document_attachments
+            )
+        )
+        self.assertFalse(prepared)
+        self.assertEqual(document_errors, {invoice: []})
+        self.assertEqual(document_attachments, {invoice: edi_doc.attachment_id})
+
+    def test_l10n_ec_refresh_authorized_document(self):
+        """El documento autorizado al consultar el SRI lo procesa account_edi"""
+        self._setup_edi_company_ec()
+        invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+        edi_doc = invoice._get_edi_document(self.edi_format)
+        self.edi_format._l10n_ec_edi_save_attachment(
+            invoice, edi_doc, b'<factura id="comprobante"/>'
+        )
+        edi_doc.write(
+            {
+                "l10n_ec_edi_stage": "authorized",
+                "l10n_ec_authorized_xml": base64.b64encode(
+                    gzip.compress(b'<factura id="comprobante"/>')
+                ),
+            }
+        )
+        self.assertEqual(edi_doc.state, "to_send")
+        res = edi_doc._l10n_ec_refresh_authorization_status([("id", "=", edi_doc.id)])
+        self.assertEqual(res, {"checked": 1, "authorized": 1})
+        self.assertEqual(edi_doc.state, "sent")
+        self.assertFalse(edi_doc.error)
+        self.assertTrue(edi_doc.attachment_id)
+
+    def test_l10n_ec_sign_pool_error(self):
+        """Error al crear el pool de firma registrado en cada documento"""
+        self._setup_edi_company_ec()
+        invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+        edi_doc = invoice._get_edi_document(self.edi_format)
+        document_errors = {invoice: []}
+        document_attachments = {invoice: False}
+        with patch.object(
+            type(self.certificate),
+            "_get_sign_process_pool",
+            side_effect=UserError("Certificado invalido"),
+        ):
+            prepared = list(
+                self.edi_format._l10n_ec_edi_prepare_documents_parallel(
+                    [(invoice, edi_doc)],
+                    invoice.company_id,
+                    document_errors,
+                    document_attachments,
+                    2,
+                )
+            )
+        self.assertFalse(prepared)
+        self.assertIn("Certificado invalido", "".join(document_errors[invoice]))
+
+    def _l10n_ec_prepare_signed_documents(self, invoices):
+        document_errors = {}
+        document_attachments = {}
+        prepared = {
+            edi_doc: xml_signed
+            for _document, edi_doc, xml_signed in (
+                self.edi_format._l10n_ec_edi_prepare_documents(
+                    invoices, invoices.company_id, document_errors, document_attachments
+                )
+            )
+        }
+        self.assertFalse(any(document_errors.values()))
+        return prepared
+
+    def test_l10n_ec_parallel_signing(self):
+        """Firmar en el pool de procesos genera el mismo xml que en serie"""
+        self._setup_edi_company_ec()
+        invoices = self.env["account.move"]
+        for _index in range(4):
+            invoices |= self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+        edi_docs = invoices.edi_document_ids.filtered(
+            lambda x: x.edi_format_id == self.edi_format
+        )
+        ICP = self.env["ir.config_parameter"].sudo()
+        ICP.set_param("l10n_ec_edi_cpu_workers", 2)
+        key_type_class = type(self.certificate)
+        # el pool de procesos solo se usa en modo prefork
+        with patch.dict(config.options, {"workers": 2}), patch.object(
+            key_type_class,
+            "_submit_check_and_sign",
+            autospec=True,
+            side_effect=key_type_class._submit_check_and_sign,
+        ) as submit:
+            parallel = self._l10n_ec_prepare_signed_documents(invoices)
+        self.assertEqual(submit.call_count, 4)
+        # firmar nuevamente en serie, sin reutilizar el xml guardado
+        edi_docs.write({"l10n_ec_edi_stage": False, "l10n_ec_render_hash": False})
+        ICP.set_param("l10n_ec_edi_cpu_workers", 1)
+        serial = self._l10n_ec_prepare_signed_documents(invoices)
+        self.assertEqual(set(parallel), set(edi_docs))
+        self.assertEqual(set(serial), set(edi_docs))
+        for edi_doc in edi_docs:
+            # la firma cambia en cada ejecucion(fecha e identificadores)
+            # el contenido firmado debe ser el mismo
+            contents = []
+            for xml_signed in (parallel[edi_doc], serial[edi_doc]):
+                doc = etree.fromstring(xml_signed)
+                signature = doc.find("ds:Signature", namespaces=xmlsig.constants.NS_MAP)
+                self.assertIsNotNone(signature)
+                doc.remove(signature)
+                contents.append(etree.tostring(doc))
+            self.assertEqual(contents[0], contents[1])
+
+    def test_l10n_ec_attachment_saved_before_sending(self):
+        """No entregar para enviar al SRI un xml que no se pudo guardar"""
+        self._setup_edi_company_ec()
+        invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+        edi_doc = invoice._get_edi_document(self.edi_format)
+        document_errors = {}
+        document_attachments = {}
+        with patch.object(
+            type(self.edi_format),
+            "_l10n_ec_edi_save_attachments",
+            side_effect=UserError("Error al guardar"),
+        ):
+            prepared = list(
+                self.edi_format._l10n_ec_edi_prepare_documents(
+                    invoice, invoice.company_id, document_errors, document_attachments
+                )
+            )
+        self.assertFalse(prepared)
+        self.assertIn("Error al guardar", "".join(document_errors[invoice]))
+        self.assertFalse(edi_doc.l10n_ec_edi_stage)
+        # guardado el adjunto, el documento se entrega para enviarlo
+        prepared = self._l10n_ec_prepare_signed_documents(invoice)
+        self.assertEqual(list(prepared), [edi_doc])
+        self.assertEqual(edi_doc.attachment_id.raw, prepared[edi_doc])
+        self.assertEqual(edi_doc.l10n_ec_edi_stage, "signed")
+
+    def test_l10n_ec_render_again_after_rejection(self):
+        """Generar nuevamente el xml devuelto por el SRI en el siguiente intento"""
+        self._setup_edi_company_ec()
+        invoice = self._l10n_ec_prepare_edi_out_invoice(auto_post=True)
+        edi_doc = invoice._get_edi_document(self.edi_format)
+        self._l10n_ec_prepare_signed_documents(invoice)
+        self.assertEqual(edi_doc.l10n_ec_edi_stage, "signed")
+        errors, retry = self.edi_format._l10n_ec_edi_process_submission(
+            edi_doc,
+            {
+                "auth_before": False,
+                "send": {
+                    "estado": "DEVUELTA",
+                    "comprobantes": {
+                        "comprobante": [
+                            {
+                                "mensajes": {
+                                    "mensaje": [
+                                        {
+                                            "identificador": "35",
+                                            "mensaje": "ARCHIVO NO CUMPLE "
+                                            "ESTRUCTURA XML",
+                                            "tipo": "ERROR",
+                                        }
+                                    ]
+                                }
+                            }
+                        ]
+                    },
+                },
+                "sent_date": False,
+                "auth": False,
+                "send_skipped": False,
+            },
+        )
+        self.assertTrue(errors)
+        self.assertFalse(retry)
+        self.assertFalse(edi_doc.l10n_ec_edi_stage)
+        # corregidos los datos, el siguiente intento genera el xml nuevamente
+        invoice.commercial_partner_id.street = "Direccion corregida"
+        (
+            xml_signed,
+            render_data,
+            _render_hash,
+        ) = self.edi_format._l10n_ec_edi_get_reusable(edi_doc)
+        self.assertFalse(xml_signed)
+        self.assertTrue(render_data)